@@ -0,0 +1,31 @@
+import logging
+import time
+
+import redis
+from ckan.lib.redis import connect_to_redis
+
+log = logging.getLogger(__name__)
+
+# Sorted sets of the datasets changed in CKAN, scored by the time of their last
+# change: the bulk-download and coat2pycsw workers wait for changes to settle
+GEOJSON_QUEUE = "coat:geojson"
+CSW_QUEUE = "coat:csw"
+
+
+def _queue(package_id, *queues):
+    try:
+        with connect_to_redis().pipeline() as pipeline:
+            for queue in queues:
+                pipeline.zadd(queue, {package_id: time.time()})
+            pipeline.execute()
+    except redis.RedisError:
+        # the next full runs pick up the change anyway
+        log.exception("Could not queue the update of %s in %s", package_id, ", ".join(queues))
+
+
+def update_record(package_id):
+    _queue(package_id, CSW_QUEUE)
+
+
+def dataset_changed(package_id):
+    _queue(package_id, GEOJSON_QUEUE, CSW_QUEUE)
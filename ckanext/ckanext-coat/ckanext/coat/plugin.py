@@ -8,13 +8,14 @@ import ckanext.coat.logic.action.delete
 import ckanext.coat.logic.action.get
 import ckanext.coat.logic.action.update
 import ckanext.coat.logic.validators as validators
-from ckanext.coat import blueprint, helpers
+from ckanext.coat import blueprint, events, helpers
 
 
 class CoatPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IBlueprint, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IDatasetForm)
@@ -70,6 +71,32 @@ class CoatPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     def before_resource_delete(self, context, obj, *args, **kwargs):
         resource = toolkit.get_action("resource_show")(context, obj)
         helpers.is_protected(resource, action="delete")
+        # the remaining resources given to after_resource_delete may be empty
+        context["coat_deleted_resource_package"] = resource["package_id"]
+
+    def after_resource_create(self, context, resource):
+        events.dataset_changed(resource["package_id"])
+
+    def after_resource_update(self, context, resource):
+        events.dataset_changed(resource["package_id"])
+
+    def after_resource_delete(self, context, resources):
+        package_id = context.pop("coat_deleted_resource_package", None)
+        if package_id:
+            events.dataset_changed(package_id)
+
+    # IPackageController
+
+    def after_dataset_create(self, context, pkg_dict):
+        events.update_record(pkg_dict["id"])
+
+    def after_dataset_update(self, context, pkg_dict):
+        # public datasets cannot be edited: new data is published as a new version
+        events.dataset_changed(pkg_dict["id"])
+
+    def after_dataset_delete(self, context, pkg_dict):
+        # the GeoJSON files are removed by the bulk-download worker
+        events.dataset_changed(pkg_dict["id"])
 
     # IBlueprint
 
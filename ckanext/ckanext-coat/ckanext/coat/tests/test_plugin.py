@@ -1,7 +1,65 @@
 """Tests for plugin.py."""
 
-import ckanext.coat.plugin as plugin  # noqa: F401
+import pytest
+import redis
+
+import ckanext.coat.events as events
+import ckanext.coat.plugin as plugin
+
+
+class FakeRedis:
+    def __init__(self):
+        self.queued = set()
+
+    def pipeline(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def zadd(self, queue, mapping):
+        self.queued.update((queue, member) for member in mapping)
+
+    def execute(self):
+        pass
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    client = FakeRedis()
+    monkeypatch.setattr(events, "connect_to_redis", lambda: client)
+    return client.queued
 
 
 def test_plugin():
     pass
+
+
+def test_dataset_create(queued):
+    plugin.CoatPlugin().after_dataset_create({}, {"id": "abc"})
+    assert queued == {(events.CSW_QUEUE, "abc")}
+
+
+@pytest.mark.parametrize("hook", ["after_dataset_update", "after_dataset_delete"])
+def test_dataset_changed(queued, hook):
+    getattr(plugin.CoatPlugin(), hook)({}, {"id": "abc"})
+    assert queued == {(events.GEOJSON_QUEUE, "abc"), (events.CSW_QUEUE, "abc")}
+
+
+def test_resource_delete(queued):
+    context = {"coat_deleted_resource_package": "abc"}
+    plugin.CoatPlugin().after_resource_delete(context, [])
+    assert queued == {(events.GEOJSON_QUEUE, "abc"), (events.CSW_QUEUE, "abc")}
+    assert "coat_deleted_resource_package" not in context
+
+
+def test_redis_unavailable(monkeypatch):
+    def connect_to_redis():
+        raise redis.ConnectionError
+
+    monkeypatch.setattr(events, "connect_to_redis", connect_to_redis)
+    # the next full runs pick up the change
+    events.dataset_changed("abc")
@@ -1,16 +1,72 @@
 #!/usr/bin/env python3
 
+import asyncio
+import contextlib
 import datetime
+import http.cookiejar
+import json
 import logging
+import sqlite3
+import typing
 import urllib.parse
 
 import fastapi
 import httpx
 import stream_zip
 
-from .config import COAT_PUBLIC_URL, COAT_URL, GEOJSON_PATH, LOGGING
+from .cache import ArchiveCache, archive_key, is_cacheable
+from .catalog import Catalog
+from .compression import member_method
+from .config import (
+    CHUNK_SIZE,
+    COAT_PUBLIC_URL,
+    COAT_URL,
+    GEOJSON_PATH,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_TIMEOUT,
+    LOGGING,
+    ZIP_CACHE_PATH,
+    ZIP_CACHE_SIZE,
+    ZIP_COMPRESSION_LEVEL,
+    ZIP_CONNECTIONS,
+    ZIP_PREFETCH,
+    ZIP_PREFETCH_BUFFER,
+)
+from .index import has_years, layer_name, positions
+from .prefetch import prefetch
+from .storage import Spool, content_key, iter_file, local_path, resource_size
 
-app = fastapi.FastAPI()
+
+class RejectCookies(http.cookiejar.DefaultCookiePolicy):
+    """The client is shared by all users: never store cookies set by CKAN"""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    )
+    async with httpx.AsyncClient(
+        http2=True,
+        limits=limits,
+        # downloads wait for a free connection instead of failing when the pool is busy
+        timeout=httpx.Timeout(HTTP_TIMEOUT, pool=None),
+        cookies=http.cookiejar.CookieJar(RejectCookies()),
+        follow_redirects=True,
+    ) as client:
+        app.state.client = client
+        app.state.cache = ArchiveCache(ZIP_CACHE_PATH, ZIP_CACHE_SIZE)
+        app.state.catalog = Catalog()
+        app.state.catalog.refresh()
+        yield
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 logging.basicConfig(level=LOGGING)
 logger = logging.getLogger(__name__)
@@ -31,39 +87,354 @@ def external_to_internal(external_url):
         return urllib.parse.urlunsplit(external_splitted)
 
 
-def generate_archive(data, cookies):
+def forwarded_headers(request):
+    # forward the CKAN session of the user, so that private datasets are accessible
+    cookie = request.headers.get("cookie")
+    return {"cookie": cookie} if cookie else {}
+
+
+async def get_package(client, data, headers):
     package_show = urllib.parse.urljoin(COAT_URL, "api/3/action/package_show")
-    response = httpx.post(package_show, json=data, cookies=cookies).json()
-    for resource in response["result"]["resources"]:
-        last_modified = resource["last_modified"] or resource["created"]
-        modified_at = datetime.datetime.fromisoformat(last_modified)
+    response = await client.post(package_show, json=data, headers=headers)
+    body = response.json()
+    if not body.get("success"):
+        raise fastapi.HTTPException(status_code=response.status_code, detail=body.get("error"))
+    return body["result"]
+
+
+async def iter_resource(client, url, headers, connections):
+    async with connections, client.stream("GET", url, headers=headers) as response:
+        # an error page must not end up in the archive, nor in the cache
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            yield chunk
+
+
+def dataset_members(package):
+    return [(resource["name"], resource, None) for resource in package["resources"]]
+
+
+def datasets_members(packages):
+    """One folder per dataset, resources sharing the same content are downloaded only once"""
+    members = []
+    stored = {}
+    for package in packages:
+        for resource in package["resources"]:
+            name = f"{package['name']}/{resource['name']}"
+            key = content_key(resource)
+            if key in stored:
+                members.append((name, resource, stored[key]))
+                continue
+            if key is not None:
+                stored[key] = name
+            members.append((name, resource, None))
+    return members
+
+
+async def generate_archive(client, members, headers, compression="auto"):
+    """Members are (name, resource, original) tuples, where original is the name
+    of an identical member earlier in the archive"""
+    # duplicates are written in full: symbolic links are not extracted by most tools
+    spooled = {
+        original for _, resource, original in members if original and not local_path(resource)
+    }
+    spools = {}
+    # the members downloaded in advance wait for the ones before them
+    connections = asyncio.Semaphore(ZIP_CONNECTIONS)
+
+    def open_member(member):
+        name, resource, original = member
+        path = local_path(resource)
+        if path:
+            return iter_file(path)
+        if original:
+            return spools[original].read()
         internal_url = external_to_internal(resource["url"])
-        content = httpx.get(internal_url, cookies=cookies, follow_redirects=True).iter_bytes()
-        yield resource["name"], modified_at, 0o600, stream_zip.ZIP_32, content
+        content = iter_resource(client, internal_url, headers, connections)
+        if name in spooled:
+            spools[name] = Spool()
+            return spools[name].write(content)
+        return content
+
+    members = prefetch(members, open_member, ZIP_PREFETCH, ZIP_PREFETCH_BUFFER)
+    try:
+        async with contextlib.aclosing(members):
+            async for (name, resource, _), content in members:
+                last_modified = resource["last_modified"] or resource["created"]
+                modified_at = datetime.datetime.fromisoformat(last_modified)
+                method = member_method(resource, resource_size(resource), compression)
+                yield name, modified_at, 0o600, method, content
+    finally:
+        for spool in spools.values():
+            spool.close()
+
+
+async def stream_archive(client, members, headers, compression):
+    # stream_zip does not close the members, whose downloads must stop with the archive
+    async with contextlib.aclosing(
+        generate_archive(client, members, headers, compression)
+    ) as files:
+        async for chunk in stream_zip.async_stream_zip(files):
+            yield chunk
+
+
+def etag_matches(request, etag):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+async def archive_response(request, packages, members, filename, compression):
+    client = request.app.state.client
+    headers = forwarded_headers(request)
+    response_headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+    cache = request.app.state.cache
+    key = None
+    if cache.enabled and all(is_cacheable(package) for package in packages):
+        key = archive_key(packages, compression, ZIP_COMPRESSION_LEVEL)
+    if not key:
+        return fastapi.responses.StreamingResponse(
+            stream_archive(client, members, headers, compression),
+            media_type="application/zip",
+            headers=response_headers,
+        )
+
+    # the archive is fully determined by the package metadata
+    etag = f'"{key}"'
+    response_headers["ETag"] = etag
+    if etag_matches(request, etag):
+        return fastapi.Response(status_code=304, headers={"ETag": etag})
+
+    path = cache.get(key)
+    if not path:
+        archive = stream_archive(client, members, headers, compression)
+        if "range" not in request.headers:
+            return fastapi.responses.StreamingResponse(
+                cache.tee(key, archive), media_type="application/zip", headers=response_headers
+            )
+        # resuming a download: build the whole archive before serving the requested bytes
+        path = await cache.fill(key, archive)
+
+    return fastapi.responses.FileResponse(
+        path, media_type="application/zip", headers=response_headers
+    )
+
+
+Compression = typing.Literal["auto", "store"]
 
 
 @app.get("/dataset/{dataset_id}/zip")
-async def download_zip(request: fastapi.Request, dataset_id):
-    data = {"id": dataset_id}
-    return fastapi.responses.StreamingResponse(
-        stream_zip.stream_zip(generate_archive(data, request.cookies)),
-        media_type="application/zip",
-        headers={"Content-Disposition": f'attachment; filename="{dataset_id}.zip"'},
+async def download_zip(request: fastapi.Request, dataset_id, compression: Compression = "auto"):
+    client = request.app.state.client
+    package = await get_package(client, {"id": dataset_id}, forwarded_headers(request))
+    members = dataset_members(package)
+    return await archive_response(request, [package], members, f"{dataset_id}.zip", compression)
+
+
+async def get_packages(request, dataset_ids):
+    """Retrieve the datasets concurrently, skipping the ones not accessible to the user"""
+    client = request.app.state.client
+    headers = forwarded_headers(request)
+    results = await asyncio.gather(
+        *(get_package(client, {"id": dataset_id}, headers) for dataset_id in dataset_ids),
+        return_exceptions=True,
     )
+    packages = []
+    for dataset_id, result in zip(dataset_ids, results, strict=True):
+        if isinstance(result, fastapi.HTTPException):
+            logger.warning("Skipping dataset %s: %s", dataset_id, result.detail)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            packages.append(result)
+    return packages
 
 
-def read_geojson(dataset_id):
-    with (GEOJSON_PATH / dataset_id).open(mode="rb") as geojson:
-        yield from geojson
+@app.get("/datasets/zip")
+async def download_datasets_zip(
+    request: fastapi.Request,
+    dataset_ids: typing.Annotated[list[str], fastapi.Query(alias="id")],
+    compression: Compression = "auto",
+):
+    packages = await get_packages(request, list(dict.fromkeys(dataset_ids)))
+    if not packages:
+        raise fastapi.HTTPException(status_code=404, detail="No dataset found")
+    members = datasets_members(packages)
+    return await archive_response(request, packages, members, "datasets.zip", compression)
 
 
-@app.get("/dataset/{dataset_id}/geojson")
-async def download_geojson(request: fastapi.Request, dataset_id):
+@app.get("/state-variable/{state_variable_id}/zip")
+async def download_state_variable_zip(
+    request: fastapi.Request, state_variable_id, compression: Compression = "auto"
+):
+    client = request.app.state.client
+    state_variable = await get_package(
+        client, {"id": state_variable_id}, forwarded_headers(request)
+    )
+    datasets = state_variable.get("datasets") or []
+    if isinstance(datasets, str):
+        datasets = datasets.split(",")
+    dataset_ids = [name.strip() for name in datasets if name.strip()]
+    packages = [state_variable, *await get_packages(request, dataset_ids)]
+    members = datasets_members(packages)
+    filename = f"{state_variable_id}.zip"
+    return await archive_response(request, packages, members, filename, compression)
+
+
+# Pre-compressed copies written by the GeoJSON builder, by order of preference
+GEOJSON_ENCODINGS = [("br", "br"), ("gzip", "gz")]
+
+
+def accepted_encodings(request):
+    accepted = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        quality = params.strip().removeprefix("q=")
+        try:
+            if quality and float(quality) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def parse_bbox(bbox):
+    try:
+        values = [float(value) for value in bbox.split(",")]
+    except ValueError:
+        values = []
+    if len(values) != 4:
+        raise fastapi.HTTPException(status_code=422, detail="bbox must be minx,miny,maxx,maxy")
+    return values
+
+
+def parse_years(year):
+    first, _, last = year.partition("-")
     try:
+        return int(first), int(last or first)
+    except ValueError:
+        raise fastapi.HTTPException(
+            status_code=422, detail="year must be a year or a range like 2000-2005"
+        ) from None
+
+
+def read_features(path, name, features):
+    """Stream the features found in the index, read from their position in the GeoJSON file"""
+    with path.open("rb") as geojson:
+        buffer = bytearray(b'{"type": "FeatureCollection", "name": ')
+        buffer += json.dumps(name).encode() + b', "features": [\n'
+        separator = b""
+        for offset, length in features:
+            geojson.seek(offset)
+            buffer += separator + geojson.read(length)
+            separator = b",\n"
+            if len(buffer) >= CHUNK_SIZE:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer += b"\n]}\n"
+        yield bytes(buffer)
+
+
+@app.get("/dataset/{dataset_id}/geojson")
+async def download_geojson(
+    request: fastapi.Request,
+    dataset_id,
+    bbox: str | None = None,
+    year: str | None = None,
+    sn_site: typing.Annotated[list[str] | None, fastapi.Query()] = None,
+):
+    path = GEOJSON_PATH / dataset_id
+    headers = {
+        "Content-Disposition": f'attachment; filename="{dataset_id}.json"',
+        "Vary": "Accept-Encoding",
+    }
+    if bbox or year or sn_site:
+        bounds = bbox and parse_bbox(bbox)
+        years = year and parse_years(year)
+        index = GEOJSON_PATH / f"{dataset_id}.index"
+        # the other files of the builder have a dot in their name, unlike datasets
+        if "." in dataset_id or not index.is_file() or not path.is_file():
+            raise fastapi.HTTPException(status_code=404, detail="This dataset cannot be filtered")
+        if years and not has_years(index):
+            # built from remote files through a VRT, which loses the year of the features
+            raise fastapi.HTTPException(
+                status_code=422, detail="This dataset cannot be filtered by year"
+            )
+        features = positions(index, bounds, years, sn_site)
         return fastapi.responses.StreamingResponse(
-            read_geojson(dataset_id),
+            read_features(path, layer_name(index), features),
             media_type="application/json",
-            headers={"Content-Disposition": f'attachment; filename="{dataset_id}.json"'},
+            headers=headers,
         )
-    except Exception:
+
+    entry = None if "." in dataset_id else request.app.state.catalog.get(dataset_id)
+    if not entry or entry["features"] == 0:
         return {"type": "FeatureCollection", "features": [], "name": dataset_id}
+
+    # each content coding is a different representation, with its own ETag
+    version = f"{entry['mtime']:x}-{entry['size']:x}"
+    etag = f'"{version}"'
+    accepted = accepted_encodings(request)
+    for coding, suffix in GEOJSON_ENCODINGS:
+        compressed = GEOJSON_PATH / f"{dataset_id}.{suffix}"
+        if coding in accepted and compressed.is_file():
+            path = compressed
+            headers["Content-Encoding"] = coding
+            etag = f'"{version}-{suffix}"'
+            break
+    headers["ETag"] = etag
+    if etag_matches(request, etag):
+        return fastapi.Response(status_code=304, headers={"ETag": etag, "Vary": "Accept-Encoding"})
+    return fastapi.responses.FileResponse(path, media_type="application/json", headers=headers)
+
+
+def download_output(dataset_id, suffix, media_type):
+    path = GEOJSON_PATH / f"{dataset_id}.{suffix}"
+    if not path.is_file():
+        raise fastapi.HTTPException(status_code=404, detail="No spatial data for this dataset")
+    # FileResponse answers range requests, for clients reading only the features they need
+    return fastapi.responses.FileResponse(
+        path, media_type=media_type, filename=f"{dataset_id}.{suffix}"
+    )
+
+
+@app.get("/dataset/{dataset_id}/geoparquet")
+async def download_geoparquet(dataset_id):
+    return download_output(dataset_id, "parquet", "application/vnd.apache.parquet")
+
+
+@app.get("/dataset/{dataset_id}/fgb")
+async def download_flatgeobuf(dataset_id):
+    return download_output(dataset_id, "fgb", "application/flatgeobuf")
+
+
+def read_tile(path, z, x, y):
+    # MBTiles rows are numbered from the south, as in TMS
+    with contextlib.closing(sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)) as db:
+        row = db.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, 2**z - 1 - y),
+        ).fetchone()
+    return row[0] if row else None
+
+
+TileIndex = typing.Annotated[int, fastapi.Path(ge=0)]
+
+
+@app.get("/dataset/{dataset_id}/tiles/{z}/{x}/{y}.mvt")
+def download_tile(
+    dataset_id, z: typing.Annotated[int, fastapi.Path(ge=0, le=30)], x: TileIndex, y: TileIndex
+):
+    path = GEOJSON_PATH / f"{dataset_id}.mbtiles"
+    if not path.is_file():
+        raise fastapi.HTTPException(status_code=404, detail="No spatial data for this dataset")
+    tile = read_tile(path, z, x, y)
+    if tile is None:
+        # no site in this tile
+        return fastapi.Response(status_code=204)
+    headers = {"Content-Encoding": "gzip"} if tile.startswith(b"\x1f\x8b") else {}
+    return fastapi.Response(tile, media_type="application/vnd.mapbox-vector-tile", headers=headers)
@@ -0,0 +1,96 @@
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+def is_under_embargo(package):
+    embargo = package.get("embargo")
+    if not embargo:
+        return False
+    try:
+        return datetime.datetime.now() < datetime.datetime.strptime(embargo, "%Y-%m-%d")
+    except ValueError:
+        return False
+
+
+def is_cacheable(package):
+    # the content of private or embargoed datasets depends on the user
+    return not package.get("private", False) and not is_under_embargo(package)
+
+
+def archive_key(packages, *options):
+    fingerprint = [options]
+    for package in packages:
+        resources = [(res["id"], res["last_modified"]) for res in package["resources"]]
+        fingerprint.append([package["id"], package["metadata_modified"], resources])
+    return hashlib.sha256(json.dumps(fingerprint).encode()).hexdigest()
+
+
+class ArchiveCache:
+    """Size-bounded LRU cache of dataset archives, keyed by archive_key"""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if self.enabled:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        path = self.path / f"{key}.zip"
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    async def tee(self, key, chunks):
+        """Yield the chunks while writing them to the cache"""
+        complete = False
+        part = tempfile.NamedTemporaryFile(dir=self.path, suffix=".part", delete=False)
+        try:
+            async with contextlib.aclosing(chunks):
+                async for chunk in chunks:
+                    await asyncio.to_thread(part.write, chunk)
+                    yield chunk
+            complete = True
+        finally:
+            part.close()
+            if complete:
+                pathlib.Path(part.name).replace(self.path / f"{key}.zip")
+                self.evict()
+            else:
+                pathlib.Path(part.name).unlink()
+
+    async def fill(self, key, chunks):
+        """Write all the chunks to the cache and return the path of the archive"""
+        async for _ in self.tee(key, chunks):
+            pass
+        return self.path / f"{key}.zip"
+
+    def evict(self):
+        archives = []
+        for path in self.path.glob("*.zip"):
+            try:
+                archives.append((path.stat(), path))
+            except FileNotFoundError:
+                continue
+        archives.sort(key=lambda archive: archive[0].st_mtime, reverse=True)
+        total = 0
+        for index, (stat, path) in enumerate(archives):
+            total += stat.st_size
+            # the most recent archive is always kept, as it may be about to be served
+            if total > self.max_size and index > 0:
+                logger.info("Evicting %s from the archive cache", path.name)
+                path.unlink(missing_ok=True)
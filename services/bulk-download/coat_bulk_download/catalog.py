@@ -0,0 +1,93 @@
+import json
+
+from .config import GEOJSON_PATH
+from .index import count_features
+
+# dataset names cannot start with a dot, so this never collides with a GeoJSON file
+CATALOG_PATH = GEOJSON_PATH / ".catalog.json"
+
+
+def describe(dataset):
+    """Size, modification time and number of features of a built GeoJSON file"""
+    try:
+        stat = (GEOJSON_PATH / dataset).stat()
+    except FileNotFoundError:
+        return None
+    index = GEOJSON_PATH / f"{dataset}.index"
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "features": count_features(index) if index.is_file() else None,
+    }
+
+
+def load_catalog():
+    try:
+        with CATALOG_PATH.open() as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def scan_catalog():
+    """Describe the GeoJSON files already built, named after their dataset"""
+    catalog = {}
+    for path in GEOJSON_PATH.iterdir():
+        if "." not in path.name:
+            update_entry(catalog, path.name)
+    return catalog
+
+
+def update_entry(catalog, dataset, dataset_id=None):
+    entry = describe(dataset)
+    if entry:
+        # the CKAN id finds the files of a dataset that is no longer public
+        if dataset_id:
+            entry["id"] = dataset_id
+        elif "id" in catalog.get(dataset, {}):
+            entry["id"] = catalog[dataset]["id"]
+        catalog[dataset] = entry
+    else:
+        catalog.pop(dataset, None)
+
+
+def find_dataset(catalog, dataset_id):
+    """Name of the built dataset with this CKAN id"""
+    for dataset, entry in catalog.items():
+        if entry.get("id") == dataset_id:
+            return dataset
+    return None
+
+
+def save_catalog(catalog):
+    partial = CATALOG_PATH.with_suffix(".part")
+    with partial.open("w") as f:
+        json.dump(catalog, f)
+    partial.replace(CATALOG_PATH)
+
+
+class Catalog:
+    """The catalog written by the builder, reloaded when it changes"""
+
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        self.mtime = None
+        self.entries = None
+
+    def refresh(self):
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self.mtime = self.entries = None
+            return
+        if mtime != self.mtime:
+            with self.path.open() as f:
+                self.entries = json.load(f)
+            self.mtime = mtime
+
+    def get(self, dataset):
+        self.refresh()
+        if self.entries is None:
+            # not written by the builder yet
+            return describe(dataset)
+        return self.entries.get(dataset)
@@ -0,0 +1,50 @@
+import pathlib
+
+import stream_zip
+
+from .config import ZIP_COMPRESSION_LEVEL
+
+# formats and extensions of files that are already compressed
+COMPRESSED_FORMATS = {
+    "7z",
+    "bz2",
+    "docx",
+    "geotiff",
+    "gif",
+    "gz",
+    "gzip",
+    "jpeg",
+    "jpg",
+    "nc",
+    "netcdf",
+    "png",
+    "pptx",
+    "rar",
+    "tif",
+    "tiff",
+    "webp",
+    "xlsx",
+    "xz",
+    "zip",
+    "zst",
+}
+
+# above the ZIP_AUTO threshold, so that members of unknown size are written as ZIP64
+UNKNOWN_SIZE = 0xFFFFFFFF + 1
+
+
+def is_compressed(resource):
+    extension = pathlib.PurePosixPath(resource["name"]).suffix.lstrip(".")
+    formats = {(resource.get("format") or "").lower(), extension.lower()}
+    return not formats.isdisjoint(COMPRESSED_FORMATS)
+
+
+def member_method(resource, size, compression="auto"):
+    """Choose compression level and ZIP32/ZIP64 for a resource"""
+    # the stored method would make stream_zip buffer the whole member to compute the CRC,
+    # while a deflate stream with level 0 costs about the same
+    if compression == "store" or is_compressed(resource):
+        level = 0
+    else:
+        level = ZIP_COMPRESSION_LEVEL
+    return stream_zip.ZIP_AUTO(UNKNOWN_SIZE if size is None else size, level=level)
@@ -10,3 +10,43 @@ COAT_PUBLIC_URL = os.getenv("COAT_PUBLIC_URL", COAT_URL)
 
 LOGGING = os.getenv("LOGGING", "INFO")
 GEOJSON_PATH = pathlib.Path(os.getenv("GEOJSON_PATH", "/app/geojson"))
+
+# Connection pool shared by all the requests made to CKAN, an archive holds a
+# connection for as long as a member is streamed to a possibly slow client
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))
+
+# Resources downloaded in advance while the current archive member is written,
+# each buffering at most ZIP_PREFETCH_BUFFER bytes
+ZIP_PREFETCH = int(os.getenv("ZIP_PREFETCH", 3))
+ZIP_PREFETCH_BUFFER = int(os.getenv("ZIP_PREFETCH_BUFFER", 1024 * 1024))
+# Connections to CKAN held at once by an archive, the current member included
+ZIP_CONNECTIONS = int(os.getenv("ZIP_CONNECTIONS", 2))
+CHUNK_SIZE = 64 * 1024
+
+# On-disk cache of the archives of public datasets, 0 disables it
+ZIP_CACHE_PATH = pathlib.Path(os.getenv("ZIP_CACHE_PATH", "/app/cache"))
+ZIP_CACHE_SIZE = int(os.getenv("ZIP_CACHE_SIZE", 10 * 1024**3))
+
+# Read uploaded resources from the CKAN storage (mounted read-only) instead of HTTP
+CKAN_STORAGE_PATH = os.getenv("CKAN_STORAGE_PATH")
+STORAGE_READ_SIZE = int(os.getenv("STORAGE_READ_SIZE", 1024 * 1024))
+
+# Deflate level of the archive members that are not already compressed
+ZIP_COMPRESSION_LEVEL = int(os.getenv("ZIP_COMPRESSION_LEVEL", 6))
+
+# Concurrent requests per host when fetching the input files of a GeoJSON conversion
+HEAD_CONCURRENCY = int(os.getenv("HEAD_CONCURRENCY", 8))
+
+# Local copies of the input files of the GeoJSON conversions, empty to read them via /vsicurl/
+INPUT_CACHE_PATH = os.getenv("INPUT_CACHE_PATH", "/app/input-cache")
+
+# Zoom levels of the vector tiles of the sampling sites of each dataset
+TILES_MAXZOOM = int(os.getenv("TILES_MAXZOOM", 12))
+
+# Queue of the datasets to rebuild, filled by ckanext-coat when they change,
+# and seconds without changes before a dataset is rebuilt
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/1")
+GEOJSON_QUEUE = os.getenv("GEOJSON_QUEUE", "coat:geojson")
+GEOJSON_DEBOUNCE = int(os.getenv("GEOJSON_DEBOUNCE", 60))
@@ -0,0 +1,184 @@
+import functools
+import gzip
+import logging
+import shutil
+
+import brotli
+from osgeo import gdal, ogr, osr
+
+from .config import GEOJSON_PATH, TILES_MAXZOOM
+
+logger = logging.getLogger(__name__)
+
+# Outputs written next to each GeoJSON file: (driver, suffix, layer creation options)
+OUTPUTS = [
+    ("FlatGeobuf", "fgb", ["SPATIAL_INDEX=YES"]),
+    ("Parquet", "parquet", ["GEOMETRY_ENCODING=WKB"]),
+]
+
+# Pre-compressed copies of the GeoJSON file, served according to Accept-Encoding
+COMPRESSED = ["gz", "br"]
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+COPY_SIZE = 1024 * 1024
+
+
+def output_path(dataset, suffix):
+    # dataset names never contain dots, so this never collides with a GeoJSON file
+    return GEOJSON_PATH / f"{dataset}.{suffix}"
+
+
+def partial_path(dataset, suffix):
+    # the drivers pick the file format from the extension
+    return GEOJSON_PATH / f".{dataset}.part.{suffix}"
+
+
+@functools.cache
+def available_outputs():
+    outputs = []
+    for driver_name, suffix, options in OUTPUTS:
+        if ogr.GetDriverByName(driver_name):
+            outputs.append((driver_name, suffix, options))
+        else:
+            logger.warning("GDAL has no %s driver, skipping the .%s outputs", driver_name, suffix)
+    return outputs
+
+
+def wgs84():
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+class LayerWriter:
+    """Write point features with string fields to an OGR layer"""
+
+    def __init__(self, driver_name, path, layer_name, fields, options):
+        path.unlink(missing_ok=True)
+        self.path = path
+        self.dataset = ogr.GetDriverByName(driver_name).CreateDataSource(str(path))
+        self.layer = self.dataset.CreateLayer(layer_name, wgs84(), ogr.wkbPoint, options=options)
+        for field in fields:
+            self.layer.CreateField(ogr.FieldDefn(field, ogr.OFTString))
+        self.definition = self.layer.GetLayerDefn()
+        # FlatGeobuf cannot index features without geometry
+        self.skip_empty = driver_name == "FlatGeobuf"
+
+    def write(self, values, coordinates):
+        if coordinates is None and self.skip_empty:
+            return
+        feature = ogr.Feature(self.definition)
+        for index, value in enumerate(values):
+            if value is not None:
+                feature.SetField(index, value)
+        if coordinates is not None:
+            geometry = ogr.Geometry(ogr.wkbPoint)
+            geometry.AddPoint_2D(*coordinates)
+            feature.SetGeometry(geometry)
+        self.layer.CreateFeature(feature)
+
+    def close(self):
+        self.layer = self.definition = None
+        self.dataset = None
+
+
+def open_writers(dataset, layer_name, fields):
+    return {
+        suffix: LayerWriter(driver_name, partial_path(dataset, suffix), layer_name, fields, options)
+        for driver_name, suffix, options in available_outputs()
+    }
+
+
+def close_writers(dataset, writers, complete):
+    """Close the writers, replacing the previous outputs only when complete"""
+    for suffix, writer in writers.items():
+        writer.close()
+        if complete:
+            partial_path(dataset, suffix).replace(output_path(dataset, suffix))
+        else:
+            partial_path(dataset, suffix).unlink(missing_ok=True)
+
+
+def translate_outputs(source, dataset):
+    """Convert a GeoJSON file to the other outputs"""
+    for driver_name, suffix, options in available_outputs():
+        partial = partial_path(dataset, suffix)
+        partial.unlink(missing_ok=True)
+        translate_options = gdal.VectorTranslateOptions(
+            format=driver_name, layerCreationOptions=options, dstSRS="EPSG:4326"
+        )
+        try:
+            gdal.VectorTranslate(str(partial), str(source), options=translate_options)
+            partial.replace(output_path(dataset, suffix))
+        finally:
+            partial.unlink(missing_ok=True)
+
+
+def compress(source, dataset):
+    """Write the compressed copies of a GeoJSON file"""
+    try:
+        with source.open("rb") as f, partial_path(dataset, "gz").open("wb") as out:
+            # no file name nor timestamp in the header, the output only depends on the content
+            with gzip.GzipFile("", "wb", GZIP_LEVEL, out, mtime=0) as gz:
+                shutil.copyfileobj(f, gz, COPY_SIZE)
+
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+        with source.open("rb") as f, partial_path(dataset, "br").open("wb") as out:
+            while block := f.read(COPY_SIZE):
+                out.write(compressor.process(block))
+            out.write(compressor.finish())
+
+        for suffix in COMPRESSED:
+            partial_path(dataset, suffix).replace(output_path(dataset, suffix))
+    finally:
+        for suffix in COMPRESSED:
+            partial_path(dataset, suffix).unlink(missing_ok=True)
+
+
+@functools.cache
+def tiles_available():
+    if ogr.GetDriverByName("MVT"):
+        return True
+    logger.warning("GDAL has no MVT driver, skipping the .mbtiles outputs")
+    return False
+
+
+def translate_tiles(coordinates, dataset, layer_name):
+    """Write the vector tiles of the sampling sites to an MBTiles file"""
+    partial = partial_path(dataset, "mbtiles")
+    partial.unlink(missing_ok=True)
+    sites = gdal.OpenEx(
+        f"CSV:{coordinates}",
+        gdal.OF_VECTOR,
+        open_options=["X_POSSIBLE_NAMES=e_dd", "Y_POSSIBLE_NAMES=n_dd"],
+    )
+    options = gdal.VectorTranslateOptions(
+        format="MVT",
+        srcSRS="EPSG:4326",
+        layerName=layer_name,
+        datasetCreationOptions=["MINZOOM=0", f"MAXZOOM={TILES_MAXZOOM}", f"NAME={dataset}"],
+    )
+    try:
+        gdal.VectorTranslate(str(partial), sites, options=options)
+        partial.replace(output_path(dataset, "mbtiles"))
+    finally:
+        sites = None
+        partial.unlink(missing_ok=True)
+
+
+def write_tiles(coordinates, dataset, layer_name):
+    """Write the vector tiles, the dataset is still served without them"""
+    if not tiles_available():
+        return
+    try:
+        translate_tiles(coordinates, dataset, layer_name)
+    except Exception:
+        logger.exception("%s, could not write the vector tiles", dataset)
+        # outdated tiles would not match the other outputs
+        output_path(dataset, "mbtiles").unlink(missing_ok=True)
+
+
+def remove_outputs(dataset):
+    for suffix in [*(suffix for _, suffix, _ in OUTPUTS), *COMPRESSED, "mbtiles", "index"]:
+        output_path(dataset, suffix).unlink(missing_ok=True)
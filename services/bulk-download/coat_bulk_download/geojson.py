@@ -1,13 +1,35 @@
+import asyncio
+import collections
+import csv
+import hashlib
+import json
 import logging
+import pathlib
 import re
+import urllib.parse
+import uuid
 
 import httpx
 from osgeo import gdal
 
-from .config import GEOJSON_PATH, TEMPLATES
+from .config import GEOJSON_PATH, HEAD_CONCURRENCY, INPUT_CACHE_PATH, TEMPLATES
+from .formats import (
+    close_writers,
+    compress,
+    open_writers,
+    output_path,
+    partial_path,
+    translate_outputs,
+    write_tiles,
+)
+from .index import IndexWriter, index_geojson
+from .inputs import InputCache
 
 logger = logging.getLogger(__name__)
 
+# bump when the conversion changes, to rebuild every dataset
+BUILDER_VERSION = 6
+
 
 class MissingDataException(Exception):
     def __init__(self, msg="missing coordinates or year files", *args, **kwargs):
@@ -15,20 +37,131 @@ class MissingDataException(Exception):
 
 
 def vrt_to_geojson(context, dataset):
-    # Create a virtual in-memory file for the VRT content
-    vrt_mem_file = "/vsimem/input.vrt"
+    # Create a virtual in-memory file for the VRT content, unique for concurrent conversions
+    vrt_mem_file = f"/vsimem/{dataset}-{uuid.uuid4().hex}.vrt"
     template = TEMPLATES.get_template("definition.xml")
 
     text = template.render(context)
     gdal.FileFromMemBuffer(vrt_mem_file, bytes(text, "utf-8"))
 
-    # Convert VRT to GeoJSON
+    # Convert VRT to GeoJSON, replacing the previous file only when complete
+    destination = GEOJSON_PATH / dataset
+    partial = GEOJSON_PATH / f".{dataset}.part"
+    partial.unlink(missing_ok=True)
     options = gdal.VectorTranslateOptions(format="GeoJSON")
-    gdal.VectorTranslate(str(GEOJSON_PATH / dataset), vrt_mem_file, options=options)
+    try:
+        gdal.VectorTranslate(str(partial), vrt_mem_file, options=options)
+        translate_outputs(partial, dataset)
+        compress(partial, dataset)
+        index_geojson(partial, partial_path(dataset, "index"))
+        partial_path(dataset, "index").replace(output_path(dataset, "index"))
+        partial.replace(destination)
+    finally:
+        partial.unlink(missing_ok=True)
+        partial_path(dataset, "index").unlink(missing_ok=True)
+        gdal.Unlink(vrt_mem_file)
 
 
-def handle_dataset(dataset):
-    resources = dataset["resources"]
+def open_csv(path):
+    """Read a CSV file as the GDAL CSV driver does, guessing the separator from the header"""
+    f = pathlib.Path(path).open(newline="", encoding="utf-8-sig")
+    header = f.readline()
+    f.seek(0)
+    delimiter = max(",;\t|", key=header.count)
+    return f, csv.DictReader(f, delimiter=delimiter)
+
+
+def point(row):
+    try:
+        return float(row["e_dd"]), float(row["n_dd"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def joined_rows(data, fields, sites, no_site):
+    """Yield the year, the site, the values and the coordinates of each joined row"""
+    for year in data:
+        f, reader = open_csv(year["source"])
+        with f:
+            for row in reader:
+                site_values, xy = sites.get(row.get("sn_site"), no_site)
+                values = [row.get(field) for field in fields]
+                values.extend(site_values[: len(no_site[0])])
+                yield year["year"], row.get("sn_site"), values, xy
+
+
+def join_to_geojson(context, dataset):
+    """Stream the yearly rows through an index of the coordinates by sn_site
+
+    Same output as the VRT join: yearly fields, then the coordinates fields
+    prefixed with the name of their layer, as OGR SQL names joined fields.
+    The other outputs are written in the same pass.
+    """
+    coordinates = context["coordinates"]
+    f, reader = open_csv(coordinates["source"])
+    with f:
+        sites = {}
+        for row in reader:
+            sites.setdefault(row.get("sn_site"), (list(row.values()), point(row)))
+        coordinates_fields = [f"{coordinates['name']}.{field}" for field in reader.fieldnames]
+    no_site = ([None] * len(coordinates_fields), None)
+
+    # union of the fields of the yearly files, in order of appearance
+    fields = {}
+    for year in context["data"]:
+        f, reader = open_csv(year["source"])
+        with f:
+            fields.update(dict.fromkeys(reader.fieldnames or []))
+    names = [*fields, *coordinates_fields]
+
+    destination = GEOJSON_PATH / dataset
+    partial = GEOJSON_PATH / f".{dataset}.part"
+    writers = open_writers(dataset, context["layer_name"], names)
+    index = IndexWriter(partial_path(dataset, "index"), context["layer_name"])
+    complete = False
+    try:
+        try:
+            with partial.open("wb") as out:
+                out.write(b'{"type": "FeatureCollection", "name": ')
+                out.write(json.dumps(context["layer_name"]).encode())
+                out.write(b', "features": [\n')
+                offset = out.tell()
+                separator = b""
+                rows = joined_rows(context["data"], fields, sites, no_site)
+                for year, sn_site, values, xy in rows:
+                    feature = {
+                        "type": "Feature",
+                        "properties": dict(zip(names, values, strict=True)),
+                        "geometry": {"type": "Point", "coordinates": xy} if xy else None,
+                    }
+                    encoded = json.dumps(feature, ensure_ascii=False).encode()
+                    out.write(separator)
+                    out.write(encoded)
+                    offset += len(separator)
+                    index.add(offset, len(encoded), sn_site, year, xy)
+                    offset += len(encoded)
+                    separator = b",\n"
+                    for writer in writers.values():
+                        writer.write(values, xy)
+                out.write(b"\n]}\n")
+            complete = True
+        finally:
+            index.close()
+            close_writers(dataset, writers, complete)
+        compress(partial, dataset)
+        partial_path(dataset, "index").replace(output_path(dataset, "index"))
+        partial.replace(destination)
+    finally:
+        partial.unlink(missing_ok=True)
+        partial_path(dataset, "index").unlink(missing_ok=True)
+
+
+def is_local(source):
+    return not source.startswith("/vsi")
+
+
+def select_resources(dataset):
+    """Find the yearly files and the coordinates file of a dataset"""
     base_name_value = None
 
     for extra in dataset["extras"]:
@@ -36,63 +169,116 @@ def handle_dataset(dataset):
             base_name_value = extra["value"]
             break
 
-    data = []
+    years = []
     regex = re.compile(rf"{base_name_value}_(\d\d\d\d).txt", re.I)
     coords = None
 
-    for resource in resources:
+    for resource in dataset["resources"]:
         if (
             resource["format"] == "TXT"
             and "embargo" not in resource["url"]
             and regex.match(resource["name"])
         ):
-            try:
-                response = httpx.head(resource["url"])
-                response.raise_for_status()
-                data.append(
-                    {
-                        "url": resource["url"],
-                        "name": f"{base_name_value}_{regex.match(resource['name'])[1]}",
-                    }
-                )
-            except httpx.RequestError:
-                logger.warning(
-                    "%s, %s, %s, Error request", dataset["name"], resource["name"], resource["url"]
-                )
-            except httpx.HTTPStatusError as exc:
-                logger.warning(
-                    "%s, %s, %s, %s, Error response",
-                    dataset["name"],
-                    resource["name"],
-                    resource["url"],
-                    exc.response.status_code,
-                )
+            years.append((resource, regex.match(resource["name"])[1]))
         elif resource["name"].lower() == f"{base_name_value}_coordinates.txt":
-            try:
-                response = httpx.head(resource["url"])
-                response.raise_for_status()
-                coords = resource["url"]
-            except httpx.RequestError:
-                logger.warning(
-                    "%s, %s, %s, Error request", dataset["name"], resource["name"], resource["url"]
-                )
-            except httpx.HTTPStatusError as exc:
-                logger.warning(
-                    "%s, %s, %s, %s, Error response",
-                    dataset["name"],
-                    resource["name"],
-                    resource["url"],
-                    exc.response.status_code,
-                )
+            coords = resource
+
+    return base_name_value, years, coords
+
+
+def fingerprint(dataset):
+    """Hash of the inputs of the conversion of a dataset"""
+    base_name_value, years, coords = select_resources(dataset)
+    resources = [resource for resource, _ in years] + ([coords] if coords else [])
+    inputs = [
+        BUILDER_VERSION,
+        base_name_value,
+        [
+            (resource["id"], resource["url"], resource.get("size"), resource["last_modified"])
+            for resource in resources
+        ],
+    ]
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+async def fetch_input(client, semaphore, cache, dataset, resource):
+    """Return the path GDAL reads a resource from, or None if it is not available"""
+    try:
+        async with semaphore:
+            if cache:
+                return str(await cache.get(client, resource))
+            response = await client.head(resource["url"])
+        response.raise_for_status()
+    except httpx.RequestError:
+        logger.warning(
+            "%s, %s, %s, Error request", dataset["name"], resource["name"], resource["url"]
+        )
+    except httpx.HTTPStatusError as exc:
+        logger.warning(
+            "%s, %s, %s, %s, Error response",
+            dataset["name"],
+            resource["name"],
+            resource["url"],
+            exc.response.status_code,
+        )
+    else:
+        return f"/vsicurl/{resource['url']}"
+    return None
+
+
+async def fetch_inputs(dataset, resources):
+    """Fetch all the resources concurrently, with a limit of requests per host"""
+    semaphores = collections.defaultdict(lambda: asyncio.Semaphore(HEAD_CONCURRENCY))
+    cache = InputCache(INPUT_CACHE_PATH) if INPUT_CACHE_PATH else None
+    async with httpx.AsyncClient(follow_redirects=True, timeout=60) as client:
+        fetches = []
+        for resource in resources:
+            host = urllib.parse.urlsplit(resource["url"]).netloc
+            fetches.append(fetch_input(client, semaphores[host], cache, dataset, resource))
+        sources = await asyncio.gather(*fetches)
+    return {
+        resource["id"]: source
+        for resource, source in zip(resources, sources, strict=True)
+        if source
+    }
+
+
+def handle_dataset(dataset):
+    base_name_value, years, coords = select_resources(dataset)
+
+    candidates = [resource for resource, _ in years] + ([coords] if coords else [])
+    sources = asyncio.run(fetch_inputs(dataset, candidates))
+    data = [
+        {
+            "source": sources[resource["id"]],
+            "name": f"{base_name_value}_{year}",
+            "year": int(year),
+        }
+        for resource, year in years
+        if resource["id"] in sources
+    ]
+    if coords and coords["id"] not in sources:
+        coords = None
 
     if not coords or not data:
         raise MissingDataException
 
-    vrt_to_geojson(
-        {
-            "layer_name": base_name_value,
-            "coordinates": {"url": coords, "name": f"{base_name_value}_coordinates"},
-            "data": data,
+    context = {
+        "layer_name": base_name_value,
+        "coordinates": {
+            "source": sources[coords["id"]],
+            "name": f"{base_name_value}_coordinates",
         },
-        dataset["name"],
-    )
+        "data": data,
+    }
+    if all(is_local(source) for source in sources.values()):
+        try:
+            join_to_geojson(context, dataset["name"])
+        except UnicodeDecodeError as exc:
+            # GDAL reads the files that are not UTF-8, like it did before the join
+            logger.warning("%s, %s, converting with GDAL", dataset["name"], exc)
+            vrt_to_geojson(context, dataset["name"])
+    else:
+        # the input files are read remotely by GDAL
+        vrt_to_geojson(context, dataset["name"])
+    write_tiles(context["coordinates"]["source"], dataset["name"], base_name_value)
@@ -0,0 +1,110 @@
+import contextlib
+import json
+import sqlite3
+
+# Position of each feature in the GeoJSON file, with the attributes it can be filtered by
+SCHEMA = """
+CREATE TABLE metadata (name TEXT);
+CREATE TABLE features (
+    offset INTEGER, length INTEGER, sn_site TEXT, year INTEGER, x REAL, y REAL
+);
+"""
+INDEXES = """
+CREATE INDEX features_sn_site ON features (sn_site);
+CREATE INDEX features_year ON features (year);
+CREATE INDEX features_xy ON features (x, y);
+"""
+BATCH_SIZE = 10000
+
+
+class IndexWriter:
+    def __init__(self, path, name):
+        path.unlink(missing_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.db.execute("INSERT INTO metadata VALUES (?)", (name,))
+        self.rows = []
+
+    def add(self, offset, length, sn_site, year, xy):
+        x, y = xy or (None, None)
+        self.rows.append((offset, length, sn_site, year, x, y))
+        if len(self.rows) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany("INSERT INTO features VALUES (?, ?, ?, ?, ?, ?)", self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        # the indexes are faster to build once all the rows are inserted
+        self.db.executescript(INDEXES)
+        self.db.commit()
+        self.db.close()
+
+
+def index_geojson(source, path):
+    """Index a GeoJSON file written with one feature per line, as GDAL does"""
+    with source.open("rb") as f:
+        name = None
+        writer = None
+        offset = 0
+        for line in f:
+            feature = line.rstrip(b",\r\n")
+            if feature.startswith((b'{ "type": "Feature"', b'{"type": "Feature"')):
+                data = json.loads(feature)
+                geometry = data.get("geometry") or {}
+                xy = geometry.get("coordinates") if geometry.get("type") == "Point" else None
+                properties = data.get("properties") or {}
+                writer.add(offset, len(feature), properties.get("sn_site"), None, xy)
+            elif writer is None and line.startswith(b'"name": '):
+                name = json.loads(line.rstrip(b",\r\n").partition(b":")[2])
+            if writer is None and line.startswith(b'"features": ['):
+                writer = IndexWriter(path, name)
+            offset += len(line)
+    if writer is None:
+        raise ValueError(f"{source} is not a GeoJSON file written by GDAL")
+    writer.close()
+
+
+def count_features(path):
+    with contextlib.closing(sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)) as db:
+        (count,) = db.execute("SELECT count(*) FROM features").fetchone()
+    return count
+
+
+def layer_name(path):
+    with contextlib.closing(sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)) as db:
+        (name,) = db.execute("SELECT name FROM metadata").fetchone()
+    return name
+
+
+def has_years(path):
+    """Whether the year of the features was recorded, which index_geojson cannot do"""
+    with contextlib.closing(sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)) as db:
+        query = "SELECT 1 FROM features WHERE year IS NOT NULL LIMIT 1"
+        return db.execute(query).fetchone() is not None
+
+
+def positions(path, bbox=None, years=None, sites=None):
+    """Yield the offset and the length of the matching features, in file order"""
+    conditions = []
+    params = []
+    if bbox:
+        conditions.append("x BETWEEN ? AND ? AND y BETWEEN ? AND ?")
+        params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+    if years:
+        conditions.append("year BETWEEN ? AND ?")
+        params.extend(years)
+    if sites:
+        conditions.append(f"sn_site IN ({', '.join('?' * len(sites))})")
+        params.extend(sites)
+    where = " AND ".join(conditions) or "1"
+
+    # the rows may be consumed from several threads, one at a time
+    db = sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True, check_same_thread=False)
+    with contextlib.closing(db):
+        yield from db.execute(
+            f"SELECT offset, length FROM features WHERE {where} ORDER BY offset",  # noqa: S608
+            params,
+        )
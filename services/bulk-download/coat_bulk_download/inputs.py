@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import pathlib
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class InputCache:
+    """Content-addressed copies of the input files, validated by ETag and last_modified"""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.blobs = self.path / "blobs"
+        self.index = self.path / "index"
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.index.mkdir(parents=True, exist_ok=True)
+
+    def _entry_path(self, url):
+        return self.index / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+
+    def _read_entry(self, url):
+        try:
+            with self._entry_path(url).open() as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return entry if (self.blobs / entry["sha256"]).exists() else None
+
+    def _write_entry(self, url, entry):
+        path = self._entry_path(url)
+        partial = path.with_suffix(".part")
+        with partial.open("w") as f:
+            json.dump(entry, f)
+        partial.replace(path)
+
+    async def get(self, client, resource):
+        """Return the local path of a resource, downloading it only when it changed"""
+        url = resource["url"]
+        entry = self._read_entry(url)
+        headers = {}
+        if entry:
+            if resource["last_modified"] and entry["last_modified"] == resource["last_modified"]:
+                return self.blobs / entry["sha256"]
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+
+        async with client.stream("GET", url, headers=headers) as response:
+            if entry and response.status_code == 304:
+                entry["last_modified"] = resource["last_modified"]
+                self._write_entry(url, entry)
+                return self.blobs / entry["sha256"]
+            response.raise_for_status()
+            digest = hashlib.sha256()
+            part = tempfile.NamedTemporaryFile(dir=self.path, suffix=".part", delete=False)
+            try:
+                with part:
+                    async for chunk in response.aiter_bytes():
+                        part.write(chunk)
+                        digest.update(chunk)
+                blob = self.blobs / digest.hexdigest()
+                pathlib.Path(part.name).replace(blob)
+            finally:
+                pathlib.Path(part.name).unlink(missing_ok=True)
+
+        entry = {
+            "etag": response.headers.get("etag"),
+            "last_modified": resource["last_modified"],
+            "sha256": digest.hexdigest(),
+        }
+        self._write_entry(url, entry)
+        return blob
+
+    def prune(self, grace=3600):
+        """Remove the blobs no longer referenced by the index, like superseded versions of a file"""
+        referenced = set()
+        for path in self.index.glob("*.json"):
+            try:
+                with path.open() as f:
+                    referenced.add(json.load(f)["sha256"])
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+        # a blob written by a concurrent download is only indexed once complete
+        cutoff = time.time() - grace
+        for blob in self.blobs.iterdir():
+            try:
+                if blob.name not in referenced and blob.stat().st_mtime < cutoff:
+                    logger.info("Pruning %s from the input cache", blob.name)
+                    blob.unlink()
+            except FileNotFoundError:
+                continue
@@ -0,0 +1,60 @@
+import asyncio
+import collections
+import contextlib
+
+from .config import CHUNK_SIZE
+
+_END = object()
+
+
+class Prefetch:
+    """Consume an async iterator of chunks in the background, buffering up to `buffer_size` bytes"""
+
+    def __init__(self, chunks, buffer_size):
+        self.queue = asyncio.Queue(maxsize=max(1, buffer_size // CHUNK_SIZE))
+        self.task = asyncio.create_task(self._fill(chunks))
+
+    async def _fill(self, chunks):
+        try:
+            async with contextlib.aclosing(chunks):
+                async for chunk in chunks:
+                    await self.queue.put(chunk)
+        except Exception as exc:
+            await self.queue.put(exc)
+        else:
+            await self.queue.put(_END)
+
+    async def __aiter__(self):
+        while (chunk := await self.queue.get()) is not _END:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def cancel(self):
+        self.task.cancel()
+
+    async def close(self):
+        """Stop the download, closing the iterator before returning"""
+        self.cancel()
+        await asyncio.wait([self.task])
+
+
+async def prefetch(items, open_content, window, buffer_size):
+    """Yield (item, content) pairs in order, while the contents of the next `window` items
+    are already being downloaded"""
+    items = iter(items)
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) <= window and (item := next(items, _END)) is not _END:
+                pending.append((item, Prefetch(open_content(item), buffer_size)))
+            if not pending:
+                break
+            yield pending[0]
+            await pending.popleft()[1].close()
+    finally:
+        # all cancelled first, a download waiting for a connection must not take a freed one
+        for _, content in pending:
+            content.cancel()
+        for _, content in pending:
+            await content.close()
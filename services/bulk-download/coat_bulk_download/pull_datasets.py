@@ -1,32 +1,240 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import json
 import logging
+import multiprocessing
 import traceback
 import urllib.parse
+from concurrent.futures.process import BrokenProcessPool
 
 import httpx
+from osgeo import gdal
 
-from .config import COAT_URL, GEOJSON_PATH
-from .geojson import MissingDataException, handle_dataset
+from .catalog import load_catalog, save_catalog, scan_catalog, update_entry
+from .config import COAT_URL, GEOJSON_PATH, INPUT_CACHE_PATH, LOGGING
+from .formats import remove_outputs
+from .geojson import MissingDataException, fingerprint, handle_dataset
+from .inputs import InputCache
 
 logger = logging.getLogger(__name__)
 
+BUILT = "built"
+MISSING = "missing"
+FAILED = "failed"
+UNCHANGED = "unchanged"
+REMOVED = "removed"
 
-def get_datasets():
-    package_search = urllib.parse.urljoin(COAT_URL, "api/3/action/package_search?q=type:dataset")
-    response = httpx.get(package_search).json()
-    datasets = response["result"]["results"]
+# dataset names cannot start with a dot, so these never collide with a GeoJSON file
+FINGERPRINTS_PATH = GEOJSON_PATH / ".fingerprints.json"
+LOCK_PATH = GEOJSON_PATH / ".lock"
 
-    for dataset in datasets:
-        logger.info(f"processing {dataset['title']}")
-        f = GEOJSON_PATH / dataset["name"]
+
+@contextlib.contextmanager
+def locked(path=LOCK_PATH):
+    """Hold a lock shared by the full runs and the worker, the one of the fingerprints and
+    the catalog by default"""
+    with path.open("a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def building(name):
+    """Hold the lock of the files of a dataset, written through the same partial paths"""
+    return locked(GEOJSON_PATH / f".{name}.lock")
+
+
+def load_fingerprints():
+    try:
+        with FINGERPRINTS_PATH.open() as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_fingerprints(fingerprints):
+    partial = FINGERPRINTS_PATH.with_suffix(".part")
+    with partial.open("w") as f:
+        json.dump(fingerprints, f)
+    partial.replace(FINGERPRINTS_PATH)
+
+
+def is_up_to_date(dataset, fingerprints):
+    # the GeoJSON file may have been removed in the meantime
+    return (
+        fingerprints.get(dataset["name"]) == fingerprint(dataset)
+        and (GEOJSON_PATH / dataset["name"]).exists()
+    )
+
+
+def search_datasets(rows=1000, concurrency=4):
+    """Yield all the datasets of the catalog, as soon as each page arrives"""
+    package_search = urllib.parse.urljoin(COAT_URL, "api/3/action/package_search")
+    params = {"q": "type:dataset", "sort": "name asc", "rows": rows}
+
+    with httpx.Client(timeout=60) as client:
+
+        def get_page(start):
+            response = client.get(package_search, params={**params, "start": start})
+            response.raise_for_status()
+            return response.json()["result"]
+
+        first = get_page(0)
+        logger.info("Found %d datasets", first["count"])
+        yield from first["results"]
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            for page in executor.map(get_page, range(rows, first["count"], rows)):
+                yield from page["results"]
+
+
+def init_worker():
+    # each worker process has its own GDAL configuration
+    logging.basicConfig(level=LOGGING)
+    gdal.UseExceptions()
+    # only used when the input files are read via /vsicurl/
+    gdal.SetConfigOption("VSI_CACHE", "TRUE")
+    gdal.SetConfigOption("VSI_CACHE_SIZE", str(64 * 1024 * 1024))
+    gdal.SetConfigOption("CPL_VSIL_CURL_CACHE_SIZE", str(64 * 1024 * 1024))
+
+
+def remove_dataset(name):
+    (GEOJSON_PATH / name).unlink(missing_ok=True)
+    remove_outputs(name)
+
+
+def build_dataset(dataset):
+    """Convert a dataset, returning BUILT, MISSING or FAILED"""
+    logger.info(f"processing {dataset['title']}")
+    # the worker may be converting the same dataset
+    with building(dataset["name"]):
         try:
-            if f.exists():
-                f.unlink()
             handle_dataset(dataset)
         except MissingDataException as exc:
             logger.warning("%s, %s, %s", dataset["name"], MissingDataException, exc)
+            remove_dataset(dataset["name"])
+            return MISSING
         except Exception:
             logger.error("%s, %s", dataset["name"], traceback.format_exc())
+            remove_dataset(dataset["name"])
+            return FAILED
+    return BUILT
+
+
+def record_result(dataset, result):
+    """Save the fingerprint and the catalog entry of a dataset, keeping the others' changes"""
+    with locked():
+        fingerprints = load_fingerprints()
+        if result == BUILT:
+            fingerprints[dataset["name"]] = fingerprint(dataset)
+        else:
+            fingerprints.pop(dataset["name"], None)
+        save_fingerprints(fingerprints)
+
+        # the download service answers from the catalog, keep it current
+        catalog = load_catalog() or scan_catalog()
+        update_entry(catalog, dataset["name"], dataset["id"])
+        save_catalog(catalog)
+
+
+def run_pool(datasets, workers, record):
+    """Convert the datasets in a new pool of processes until one of them crashes,
+    returning the datasets whose result was lost"""
+    # GDAL is not fork-safe
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, mp_context=context, initializer=init_worker
+    ) as executor:
+        # only as many datasets as workers are submitted, as a crash loses all of them
+        running = {}
+        lost = []
+        while True:
+            while not lost and len(running) < workers:
+                dataset = next(datasets, None)
+                if dataset is None:
+                    break
+                try:
+                    running[executor.submit(build_dataset, dataset)] = dataset
+                except BrokenProcessPool:
+                    lost.append(dataset)
+            if not running:
+                return lost
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                dataset = running.pop(future)
+                try:
+                    record(dataset, future.result())
+                except BrokenProcessPool:
+                    lost.append(dataset)
+
+
+def build_in_processes(datasets, workers, record):
+    """Convert the datasets in a pool of processes, replaced when a worker crashes"""
+    datasets = iter(datasets)
+    while lost := run_pool(datasets, workers, record):
+        # converted alone, the dataset that crashed the pool is the one crashing again
+        for dataset in lost:
+            if len(lost) == 1 or run_pool(iter([dataset]), 1, record):
+                logger.error("%s, a worker process crashed", dataset["name"])
+                with building(dataset["name"]):
+                    remove_dataset(dataset["name"])
+                record(dataset, FAILED)
+
+
+def get_datasets(force=False, rows=1000, concurrency=4, workers=1):
+    # only used to skip the datasets, each result is saved as soon as it is known
+    fingerprints = {} if force else load_fingerprints()
+    results = collections.Counter()
+
+    def outdated_datasets():
+        for dataset in search_datasets(rows, concurrency):
+            if is_up_to_date(dataset, fingerprints):
+                logger.debug(f"skipping {dataset['title']}, unchanged")
+                results[UNCHANGED] += 1
+            else:
+                yield dataset
+
+    def record(dataset, result):
+        results[result] += 1
+        record_result(dataset, result)
+
+    try:
+        if workers > 1:
+            build_in_processes(outdated_datasets(), workers, record)
+        else:
+            init_worker()
+            for dataset in outdated_datasets():
+                record(dataset, build_dataset(dataset))
+    finally:
+        logger.info(
+            "%d built, %d missing data, %d failed, %d unchanged",
+            results[BUILT],
+            results[MISSING],
+            results[FAILED],
+            results[UNCHANGED],
+        )
+    if INPUT_CACHE_PATH:
+        InputCache(INPUT_CACHE_PATH).prune()
+    return results
 
 
 if __name__ == "__main__":
-    get_datasets()
+    parser = argparse.ArgumentParser(description="Build the GeoJSON files of the COAT datasets")
+    parser.add_argument(
+        "--force", action="store_true", help="rebuild all the datasets, even if unchanged"
+    )
+    parser.add_argument("--rows", type=int, default=1000, help="datasets per search page")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="search pages requested concurrently"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="datasets converted in parallel processes"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=LOGGING)
+    get_datasets(
+        force=args.force, rows=args.rows, concurrency=args.concurrency, workers=args.workers
+    )
@@ -0,0 +1,90 @@
+import asyncio
+import contextlib
+import os
+import pathlib
+import tempfile
+
+from .config import CHUNK_SIZE, CKAN_STORAGE_PATH, STORAGE_READ_SIZE
+
+
+def resource_path(resource_id):
+    # same layout as ckan.lib.uploader.ResourceUpload.get_path
+    directory = pathlib.Path(CKAN_STORAGE_PATH, "resources", resource_id[0:3], resource_id[3:6])
+    return directory / resource_id[6:]
+
+
+def local_path(resource):
+    """Path of an uploaded resource in the CKAN storage, if it can be read from there"""
+    if not CKAN_STORAGE_PATH or resource.get("url_type") != "upload":
+        return None
+    # the URL is replaced by package_show when the user cannot access the resource
+    if "embargo" in resource["url"]:
+        return None
+    path = resource_path(resource["id"])
+    return path if path.is_file() else None
+
+
+async def iter_file(path):
+    with path.open(mode="rb") as file:
+        while block := await asyncio.to_thread(file.read, STORAGE_READ_SIZE):
+            for start in range(0, len(block), CHUNK_SIZE):
+                yield block[start : start + CHUNK_SIZE]
+
+
+class Spool:
+    """Keep a copy of the chunks while they are streamed, to stream them again afterwards"""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.done = asyncio.Event()
+        self.complete = False
+
+    async def write(self, chunks):
+        try:
+            async with contextlib.aclosing(chunks):
+                async for chunk in chunks:
+                    await asyncio.to_thread(self.file.write, chunk)
+                    yield chunk
+            await asyncio.to_thread(self.file.flush)
+            self.complete = True
+        finally:
+            self.done.set()
+
+    async def read(self):
+        await self.done.wait()
+        if not self.complete:
+            raise OSError("The original content could not be read")
+        # positional reads: the same spool can be read by several members at once
+        offset = 0
+        while block := await asyncio.to_thread(
+            os.pread, self.file.fileno(), STORAGE_READ_SIZE, offset
+        ):
+            offset += len(block)
+            for start in range(0, len(block), CHUNK_SIZE):
+                yield block[start : start + CHUNK_SIZE]
+
+    def close(self):
+        self.file.close()
+
+
+def resource_size(resource):
+    path = local_path(resource)
+    if path:
+        return path.stat().st_size
+    # the size of link resources is provided by the user and cannot be trusted
+    if resource.get("url_type") == "upload":
+        return resource.get("size")
+    return None
+
+
+def content_key(resource):
+    """Identify resources with the same content, like uploads hard-linked between versions"""
+    if "embargo" in resource["url"]:
+        return None
+    path = local_path(resource)
+    if path:
+        stat = path.stat()
+        return stat.st_dev, stat.st_ino
+    if resource.get("url_type") == "upload":
+        return None
+    return resource["url"]
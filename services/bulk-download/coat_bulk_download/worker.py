@@ -0,0 +1,98 @@
+import argparse
+import logging
+import time
+import urllib.parse
+
+import httpx
+import redis
+
+from .catalog import find_dataset, load_catalog
+from .config import COAT_URL, GEOJSON_DEBOUNCE, GEOJSON_QUEUE, LOGGING, REDIS_URL
+from .pull_datasets import (
+    REMOVED,
+    build_dataset,
+    building,
+    init_worker,
+    is_up_to_date,
+    load_fingerprints,
+    record_result,
+    remove_dataset,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def get_dataset(dataset_id):
+    """The dataset as seen by the full runs, or None if it is not a public dataset"""
+    package_show = urllib.parse.urljoin(COAT_URL, "api/3/action/package_show")
+    response = httpx.get(package_show, params={"id": dataset_id}, timeout=60)
+    if response.status_code in (403, 404):
+        return None
+    response.raise_for_status()
+    dataset = response.json()["result"]
+    return dataset if dataset["type"] == "dataset" and not dataset["private"] else None
+
+
+def remove(dataset_id):
+    """Stop serving the files of a dataset deleted or made private"""
+    name = find_dataset(load_catalog(), dataset_id)
+    if name is None:
+        logger.info("skipping %s, not a public dataset", dataset_id)
+        return
+    with building(name):
+        remove_dataset(name)
+    record_result({"id": dataset_id, "name": name}, REMOVED)
+    logger.info("%s: %s", name, REMOVED)
+
+
+def rebuild(dataset_id):
+    dataset = get_dataset(dataset_id)
+    if dataset is None:
+        remove(dataset_id)
+        return
+    if is_up_to_date(dataset, load_fingerprints()):
+        logger.info("skipping %s, unchanged", dataset["name"])
+        return
+    result = build_dataset(dataset)
+    record_result(dataset, result)
+    logger.info("%s: %s", dataset["name"], result)
+
+
+def due_datasets(client, debounce):
+    """Take the datasets without changes for debounce seconds off the queue"""
+    for member in client.zrangebyscore(GEOJSON_QUEUE, "-inf", time.time() - debounce):
+        # another worker may have taken it in the meantime
+        if client.zrem(GEOJSON_QUEUE, member):
+            yield member.decode()
+
+
+def run(debounce=GEOJSON_DEBOUNCE, poll=5):
+    client = redis.Redis.from_url(REDIS_URL)
+    init_worker()
+    while True:
+        rebuilt = False
+        for dataset_id in due_datasets(client, debounce):
+            rebuilt = True
+            try:
+                rebuild(dataset_id)
+            except httpx.HTTPError:
+                logger.exception("could not retrieve %s, queued again", dataset_id)
+                client.zadd(GEOJSON_QUEUE, {dataset_id: time.time()}, nx=True)
+        if not rebuilt:
+            time.sleep(poll)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rebuild the GeoJSON files of the datasets changed in CKAN"
+    )
+    parser.add_argument(
+        "--debounce",
+        type=int,
+        default=GEOJSON_DEBOUNCE,
+        help="seconds without changes before a dataset is rebuilt",
+    )
+    parser.add_argument("--poll", type=int, default=5, help="seconds between queue checks")
+    args = parser.parse_args()
+    logging.basicConfig(level=LOGGING)
+    run(debounce=args.debounce, poll=args.poll)
@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import time
 from pathlib import Path
 from urllib.parse import urljoin
 
-import pycsw.core.admin
 import pycsw.core.config
 import requests
+import sqlalchemy
 import yaml
-from pycsw.core import metadata, repository, util
+from pycsw.core import metadata, repository
 from pygeometa.core import read_mcf
 from pygeometa.schemas.iso19139 import ISO19139OutputSchema
 from shapely.geometry import shape
@@ -26,19 +31,81 @@ COAT_PUBLIC_URL = os.getenv("COAT_PUBLIC_URL", COAT_URL)
 DATABASE = os.environ["DATABASE"]
 TABLE = "records"
 INTERVAL = int(os.getenv("INTERVAL", 86400))
+# seconds before the start of the last run also synchronised again, for the datasets
+# saved during that run but searchable only after it, and for clock skew
+OVERLAP = int(os.getenv("OVERLAP", 3600))
+# package_search pages, up to ckan.search.rows_max, and pages requested concurrently
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", 1000))
+CONCURRENCY = int(os.getenv("CONCURRENCY", 4))
+# processes rendering the records, and records inserted at once
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 1))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 100))
+# Sorted set of the datasets changed in CKAN, scored by the time of their last change,
+# consumed between the periodic runs when set
+REDIS_URL = os.getenv("REDIS_URL")
+CSW_QUEUE = "coat:csw"
+DEBOUNCE = int(os.getenv("DEBOUNCE", 5))
 
 
-def get_datasets(url):
+def new_session(concurrency=CONCURRENCY):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_datasets(session, url, fq=None, rows=PAGE_SIZE, concurrency=CONCURRENCY):
+    """Yield the datasets of the catalog matching fq, as soon as each page arrives"""
     package_search = urljoin(url, "api/3/action/package_search")
-    res = requests.get(package_search, params={"rows": 0}, timeout=10)
-    end = res.json()["result"]["count"]
-    log.info("Found %d packages in COAT catalog", end)
-    rows = 10
-    for start in range(0, end, rows):
-        res = requests.get(package_search, params={"start": start, "rows": rows}, timeout=10)
-        for dataset in res.json()["result"]["results"]:
-            if dataset["type"] == "dataset":
-                yield dataset
+    params = {"fq": " ".join(filter(None, ["+dataset_type:dataset", fq])), "sort": "id asc"}
+
+    def get_page(start):
+        res = session.get(
+            package_search, params={**params, "start": start, "rows": rows}, timeout=60
+        )
+        res.raise_for_status()
+        return res.json()["result"]
+
+    first = get_page(0)
+    log.info("Found %d datasets in COAT catalog", first["count"])
+    yield from first["results"]
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for page in executor.map(get_page, range(rows, first["count"], rows)):
+            yield from page["results"]
+
+
+def get_datasets_by_id(session, url, identifiers):
+    """Yield the datasets of the catalog among the given ids"""
+    identifiers = sorted(identifiers)
+    for start in range(0, len(identifiers), 100):
+        ids = " OR ".join(f'"{dataset_id}"' for dataset_id in identifiers[start : start + 100])
+        yield from get_datasets(session, url, f"+id:({ids})")
+
+
+def get_dataset_ids(session, url, rows=PAGE_SIZE):
+    """Ids of all the datasets in the catalog, without the rest of their metadata"""
+    package_search = urljoin(url, "api/3/action/package_search")
+    ids = set()
+    start = 0
+    while True:
+        res = session.post(
+            package_search,
+            json={
+                "fq": "+dataset_type:dataset",
+                "fl": ["id"],
+                "sort": "id asc",
+                "start": start,
+                "rows": rows,
+            },
+            timeout=60,
+        )
+        res.raise_for_status()
+        result = res.json()["result"]
+        ids.update(dataset["id"] for dataset in result["results"])
+        start += rows
+        if start >= result["count"]:
+            return ids
 
 
 def get_bbox(dataset):
@@ -56,6 +123,12 @@ with Path("mappings/topics.yaml").open() as _f:
 with Path("mappings/publishers.yml").open() as _f:
     publishers = yaml.safe_load(_f)
 
+# Email domain -> organization label, the first publisher listing a domain wins
+publisher_labels = {}
+for _publisher in publishers:
+    for _domain in _publisher.get("domains", []):
+        publisher_labels.setdefault(_domain, _publisher["label"])
+
 
 def coat2iso19115_topiccategory(category):
     """Compatibility workaround for old COAT topic category values"""
@@ -65,22 +138,25 @@ def coat2iso19115_topiccategory(category):
 def publisher_label_from_email(email):
     """Resolve the full organization label from an author's email domain."""
     domain = (email or "").strip().rsplit("@", 1)[-1].lower()
-    for publisher in publishers:
-        if domain in publisher.get("domains", []):
-            return publisher["label"]
-    return None
+    return publisher_labels.get(domain)
 
 
-def fetch_fullnames(url):
-    """Build a lookup of author email -> full name from the public user list."""
+def fetch_users(session, url, offset=0, rows=PAGE_SIZE):
+    """Yield pages of the public user list from offset, oldest users first"""
     user_list = urljoin(url, "api/3/action/user_list")
-    res = requests.get(user_list, params={"all_fields": True}, timeout=10)
-    names = {}
-    for user in res.json()["result"]:
-        fullname = user.get("fullname") or user.get("name") or ""
-        names.setdefault(user.get("email"), fullname)
-        names.setdefault(user.get("name"), fullname)
-    return names
+    while True:
+        res = session.get(
+            user_list,
+            params={"all_fields": True, "order_by": "created", "offset": offset, "limit": rows},
+            timeout=60,
+        )
+        res.raise_for_status()
+        page = res.json()["result"]
+        # CKAN may return fewer users than asked, up to ckan.user_list_limit
+        if not page:
+            return
+        yield page
+        offset += len(page)
 
 
 def normalize_datetime(timestamp):
@@ -90,124 +166,508 @@ def normalize_datetime(timestamp):
     return parsed.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-@retry(
-    stop=stop_after_delay(int(os.getenv("TIMEOUT", 300))),
-    retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout)),
-    before_sleep=before_sleep_log(log, logging.WARNING),
-)
-def main():
-    log.info("Fetching datasets from %s", COAT_URL)
-    context = pycsw.core.config.StaticContext()
-    try:
-        repository.setup(DATABASE, TABLE)
-    except OperationalError:
-        log.debug("Database already set up")
-
-    pycsw.core.admin.delete_records(context, DATABASE, TABLE)
-    repo = repository.Repository(DATABASE, context, table=TABLE)
-
-    fullnames = fetch_fullnames(COAT_URL)
-
+def to_mcf(dataset, fullnames):
+    """MCF of a dataset, as read by pygeometa"""
     # https://github.com/geopython/pygeometa/blob/0.19.0/pygeometa/schemas/iso19139/contact.j2
-    for dataset in get_datasets(COAT_URL):
-        dataset_url = urljoin(COAT_PUBLIC_URL, "dataset/" + dataset["name"])
-        author = dataset.get("author", "")
-        individualname = fullnames.get(author, author)
-        organization = publisher_label_from_email(author)
-        dataset_metadata = {
-            "mcf": {"version": 1.0},
-            "metadata": {
-                "identifier": dataset["id"],
-                "language": "en",
-                "charset": "utf8",
-                "datestamp": normalize_datetime(dataset["metadata_modified"]),
-                "dataseturi": dataset_url,
+    dataset_url = urljoin(COAT_PUBLIC_URL, "dataset/" + dataset["name"])
+    author = dataset.get("author", "")
+    individualname = fullnames.get(author, author)
+    organization = publisher_label_from_email(author)
+    dataset_metadata = {
+        "mcf": {"version": 1.0},
+        "metadata": {
+            "identifier": dataset["id"],
+            "language": "en",
+            "charset": "utf8",
+            "datestamp": normalize_datetime(dataset["metadata_modified"]),
+            "dataseturi": dataset_url,
+        },
+        "spatial": {"datatype": "vector", "geomtype": "point"},
+        "identification": {
+            "language": "en",
+            "charset": "utf8",
+            "title": {"en": dataset["title"]},
+            "abstract": {"en": dataset["notes"]},
+            "edition": dataset["version"],
+            "dates": {"creation": normalize_datetime(dataset["metadata_created"])},
+            "keywords": {
+                "default": {
+                    "keywords": {
+                        "en": [tag["name"] for tag in dataset["tags"]],
+                    }
+                }
             },
-            "spatial": {"datatype": "vector", "geomtype": "point"},
-            "identification": {
-                "language": "en",
-                "charset": "utf8",
-                "title": {"en": dataset["title"]},
-                "abstract": {"en": dataset["notes"]},
-                "edition": dataset["version"],
-                "dates": {"creation": normalize_datetime(dataset["metadata_created"])},
-                "keywords": {
-                    "default": {
-                        "keywords": {
-                            "en": [tag["name"] for tag in dataset["tags"]],
-                        }
+            "topiccategory": [coat2iso19115_topiccategory(dataset["topic_category"])],
+            "extents": {
+                "spatial": [{"bbox": get_bbox(dataset), "crs": 4326}],
+                "temporal": [
+                    {
+                        "begin": normalize_datetime(dataset.get("temporal_start")),
+                        "end": normalize_datetime(dataset.get("temporal_end")),
                     }
-                },
-                "topiccategory": [coat2iso19115_topiccategory(dataset["topic_category"])],
-                "extents": {
-                    "spatial": [{"bbox": get_bbox(dataset), "crs": 4326}],
-                    "temporal": [
-                        {
-                            "begin": normalize_datetime(dataset.get("temporal_start")),
-                            "end": normalize_datetime(dataset.get("temporal_end")),
-                        }
-                    ],
-                },
-                "fees": "None",
-                "uselimitation": dataset["license_id"].replace("_", "-"),
-                "accessconstraints": "otherRestrictions",
-                "rights": {
-                    "en": dataset["resource_citations"],
-                },
-                "url": dataset_url,
-                "status": "onGoing",
-                "maintenancefrequency": "continual",
+                ],
             },
-            "contact": {
-                "pointOfContact": {
-                    "individualname": individualname,
-                    "email": author,
-                    "organization": organization,
-                },
-                "distributor": {
-                    "individualname": "Francesco Frassinelli",
-                    "organization": "Norwegian Institute for Nature Research",
-                    "positionname": "Senior engineer IT",
-                    "url": "https://www.nina.no/vare-ansatte/francesco-frassinelli",
-                },
+            "fees": "None",
+            "uselimitation": dataset["license_id"].replace("_", "-"),
+            "accessconstraints": "otherRestrictions",
+            "rights": {
+                "en": dataset["resource_citations"],
+            },
+            "url": dataset_url,
+            "status": "onGoing",
+            "maintenancefrequency": "continual",
+        },
+        "contact": {
+            "pointOfContact": {
+                "individualname": individualname,
+                "email": author,
+                "organization": organization,
+            },
+            "distributor": {
+                "individualname": "Francesco Frassinelli",
+                "organization": "Norwegian Institute for Nature Research",
+                "positionname": "Senior engineer IT",
+                "url": "https://www.nina.no/vare-ansatte/francesco-frassinelli",
             },
-            "distribution": {
-                "landingpage": {
-                    "url": dataset_url,
-                    "type": "WWW:LINK-1.0-http--link",
-                    "rel": "canonical",
-                    "name": 'Landing page for dataset "' + dataset["name"] + '"',
-                    "description": {
-                        "en": 'Landing page for dataset "' + dataset["name"] + '"',
-                    },
-                    "function": "download",
+        },
+        "distribution": {
+            "landingpage": {
+                "url": dataset_url,
+                "type": "WWW:LINK-1.0-http--link",
+                "rel": "canonical",
+                "name": 'Landing page for dataset "' + dataset["name"] + '"',
+                "description": {
+                    "en": 'Landing page for dataset "' + dataset["name"] + '"',
                 },
-                "zip": {
-                    "url": urljoin(dataset_url + "/", "zip"),
-                    "type": "WWW:DOWNLOAD-1.0-http--download",
-                    "rel": "canonical",
-                    "name": 'ZIP-compressed dataset "' + dataset["name"] + '"',
-                    "description": {
-                        "en": 'ZIP-compressed dataset "' + dataset["name"] + '"',
-                    },
-                    "function": "download",
+                "function": "download",
+            },
+            "zip": {
+                "url": urljoin(dataset_url + "/", "zip"),
+                "type": "WWW:DOWNLOAD-1.0-http--download",
+                "rel": "canonical",
+                "name": 'ZIP-compressed dataset "' + dataset["name"] + '"',
+                "description": {
+                    "en": 'ZIP-compressed dataset "' + dataset["name"] + '"',
                 },
+                "function": "download",
             },
-        }
+        },
+    }
+    return dataset_metadata
+
+
+# Context and repository of each worker process, to parse the rendered records
+_converter = None
+
+
+def init_converter():
+    global _converter
+    context = pycsw.core.config.StaticContext()
+    _converter = context, repository.Repository(DATABASE, context, table=TABLE)
+
+
+def convert(item):
+    """Column values of the record of a dataset, with the time spent in each stage"""
+    context, repo = _converter
+    name, mcf = item
+    timings = {}
+    start = time.perf_counter()
+    mcf_dict = read_mcf(mcf)
+    timings["mcf"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    xml_string = ISO19139OutputSchema().write(mcf_dict)
+    timings["xml"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    record = metadata.parse_record(context, xml_string, repo)[0]
+    timings["parse"] = time.perf_counter() - start
+
+    # mapped objects cannot be sent back from the worker processes
+    values = {key: value for key, value in vars(record).items() if not key.startswith("_sa_")}
+    # stored as text, as Repository.insert does
+    if isinstance(values.get("xml"), bytes):
+        values["xml"] = values["xml"].decode()
+    return name, values, timings
+
+
+def convert_chunk(items):
+    return [convert(item) for item in items]
+
+
+def convert_datasets(items, workers=WORKERS):
+    """Yield the converted datasets, in order"""
+    if workers <= 1:
+        if _converter is None:
+            init_converter()
+        yield from map(convert, items)
+        return
+
+    # forking could copy the locks held by the threads fetching the datasets
+    executor = concurrent.futures.ProcessPoolExecutor(
+        workers, multiprocessing.get_context("spawn"), init_converter
+    )
+    with executor:
+        # a few chunks per worker in flight, to keep the datasets streaming
+        pending = collections.deque()
+        for chunk in batched(items, BATCH_SIZE // workers or 1):
+            pending.append(executor.submit(convert_chunk, chunk))
+            if len(pending) > 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_records(repo, records, hashes):
+    """Replace the records with the same identifiers, in a single statement each way"""
+    Record = repo.dataset
+    identifiers = [values["identifier"] for values in records]
+    repo.session.query(Record).filter(Record.identifier.in_(identifiers)).delete(
+        synchronize_session=False
+    )
+    repo.session.bulk_insert_mappings(Record, records)
+
+    repo.session.execute(record_hashes.delete().where(record_hashes.c.identifier.in_(identifiers)))
+    repo.session.execute(
+        record_hashes.insert(),
+        [{"identifier": identifier, "hash": hashes[identifier]} for identifier in identifiers],
+    )
+
+
+class Stats:
+    """Time spent in each stage of a synchronisation"""
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.started = time.perf_counter()
+        self.seconds = collections.Counter()
+        self.count = 0
+        self.unchanged = 0
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+
+    def timed_iter(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.timed(stage):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
 
-        mcf_dict = read_mcf(dataset_metadata)
-        iso_os = ISO19139OutputSchema()
-        xml_string = iso_os.write(mcf_dict)
+    def log(self):
+        elapsed = time.perf_counter() - self.started
+        log.info(
+            "Indexed %d datasets, %d unchanged, in %.1fs (%.1f/s): "
+            "fetched in %.1fs, inserted in %.1fs",
+            self.count,
+            self.unchanged,
+            elapsed,
+            self.count / elapsed,
+            self.seconds["fetch"],
+            self.seconds["insert"],
+        )
+        if self.count:
+            log.info(
+                "Per dataset, summed over %d workers: MCF %.1fms, XML %.1fms, parsing %.1fms",
+                self.workers,
+                *(self.seconds[stage] / self.count * 1000 for stage in ("mcf", "xml", "parse")),
+            )
 
-        record = metadata.parse_record(context, xml_string, repo)[0]
-        repo.insert(record, "local", util.get_today_and_now())
-        log.info("Indexed dataset %s", dataset["name"])
 
+# Last successful synchronisation, stored next to the records
+state_metadata = sqlalchemy.MetaData()
+sync_state = sqlalchemy.Table(
+    "coat2pycsw_state",
+    state_metadata,
+    sqlalchemy.Column("key", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("value", sqlalchemy.String),
+)
+# Hash of the metadata each record was rendered from
+record_hashes = sqlalchemy.Table(
+    "coat2pycsw_hashes",
+    state_metadata,
+    sqlalchemy.Column("identifier", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("hash", sqlalchemy.String),
+)
+
+
+def get_last_run(repo):
+    query = sqlalchemy.select([sync_state.c.value]).where(sync_state.c.key == "last_run")
+    return repo.session.execute(query).scalar()
+
+
+def set_last_run(repo, timestamp):
+    repo.session.execute(sync_state.delete().where(sync_state.c.key == "last_run"))
+    repo.session.execute(sync_state.insert().values(key="last_run", value=timestamp))
+
+
+# Users of CKAN, to resolve the authors without fetching all of them on each run
+users = sqlalchemy.Table(
+    "coat2pycsw_users",
+    state_metadata,
+    sqlalchemy.Column("name", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("email", sqlalchemy.String),
+    sqlalchemy.Column("fullname", sqlalchemy.String),
+    sqlalchemy.Column("created", sqlalchemy.String),
+)
+# newest users fetched again, as users deleted in CKAN shift the following ones
+USERS_OVERLAP = 100
+
+
+def refresh_users(repo, session, full=False):
+    """Fetch all the users, or add those created since the last refresh"""
+    if full:
+        repo.session.execute(users.delete())
+        known = set()
+    else:
+        known = {name for (name,) in repo.session.execute(sqlalchemy.select([users.c.name]))}
+    offset = max(0, len(known) - USERS_OVERLAP)
+
+    fetched = 0
+    for page in fetch_users(session, COAT_URL, offset):
+        # the known users are only updated by the full refreshes
+        rows = [
+            {
+                "name": user["name"],
+                "email": user.get("email"),
+                "fullname": user.get("fullname") or user.get("name") or "",
+                "created": user.get("created"),
+            }
+            for user in page
+            if user["name"] not in known
+        ]
+        if rows:
+            repo.session.execute(users.insert(), rows)
+        fetched += len(rows)
+    log.info("Fetched %d users", fetched)
+
+
+def get_fullnames(repo):
+    """Lookup of author email and user name -> full name"""
+    query = sqlalchemy.select([users.c.email, users.c.name, users.c.fullname]).order_by(
+        users.c.created
+    )
+    names = {}
+    for email, name, fullname in repo.session.execute(query):
+        names.setdefault(email, fullname)
+        names.setdefault(name, fullname)
+    return names
+
+
+def get_hashes(repo):
+    query = sqlalchemy.select([record_hashes.c.identifier, record_hashes.c.hash])
+    return dict(repo.session.execute(query).fetchall())
+
+
+def metadata_hash(dataset, mcf):
+    """Hash of everything a record is rendered from"""
+    content = json.dumps([dataset["metadata_modified"], mcf], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def delete_records(repo, identifiers):
+    Record = repo.dataset
+    repo.session.query(Record).filter(Record.identifier.in_(identifiers)).delete(
+        synchronize_session=False
+    )
+    repo.session.execute(record_hashes.delete().where(record_hashes.c.identifier.in_(identifiers)))
+
+
+def index_datasets(repo, datasets, fullnames, stored, hashes, stats):
+    """Write the records of the datasets whose metadata changed, in batches"""
+
+    def changed_datasets():
+        for dataset in datasets:
+            mcf = to_mcf(dataset, fullnames)
+            digest = metadata_hash(dataset, mcf)
+            # the stored record was rendered from the same metadata
+            if dataset["id"] in stored and hashes.get(dataset["id"]) == digest:
+                stats.unchanged += 1
+                continue
+            hashes[dataset["id"]] = digest
+            yield dataset["name"], mcf
+
+    converted = convert_datasets(stats.timed_iter("fetch", changed_datasets()), stats.workers)
+    for batch in batched(converted, BATCH_SIZE):
+        with stats.timed("insert"):
+            write_records(repo, [values for _, values, _ in batch], hashes)
+        for name, _, timings in batch:
+            stats.seconds.update(timings)
+            log.info("Indexed dataset %s", name)
+        stats.count += len(batch)
+
+
+def sync(repo, session, full=False):
+    """Update the records of the datasets modified since the last run, in one transaction"""
+    Record = repo.dataset
+
+    # changes made while this run is in progress are picked up by the next one,
+    # the datasets fetched again are skipped by their hashes
+    started = datetime.datetime.now(datetime.UTC) - datetime.timedelta(seconds=OVERLAP)
+    started = started.strftime("%Y-%m-%dT%H:%M:%SZ")
+    last_run = None if full else get_last_run(repo)
+    fq = f"+metadata_modified:[{last_run} TO *]" if last_run else None
+    log.info("Synchronising %s", f"datasets modified since {last_run}" if last_run else "all")
+
+    current = get_dataset_ids(session, COAT_URL)
+    stored = {identifier for (identifier,) in repo.session.query(Record.identifier)}
+    hashes = get_hashes(repo)
+
+    stats = Stats()
+    updated = set()
+
+    def fetched_datasets():
+        for dataset in get_datasets(session, COAT_URL, fq):
+            updated.add(dataset["id"])
+            yield dataset
+        # datasets indexed in the meantime by CKAN, or never stored
+        yield from get_datasets_by_id(session, COAT_URL, current - stored - updated)
+
+    repo.session.begin()
+    try:
+        # the users renamed in CKAN are picked up by the full synchronisation at startup
+        refresh_users(repo, session, full=full)
+        fullnames = get_fullnames(repo)
+        index_datasets(repo, fetched_datasets(), fullnames, stored, hashes, stats)
+
+        # deleted, made private or replaced by a newer version
+        deleted = stored - current
+        if deleted:
+            delete_records(repo, deleted)
+            log.info("Removed %d datasets", len(deleted))
+
+        set_last_run(repo, started)
+        with stats.timed("insert"):
+            repo.session.commit()
+    except Exception:
+        repo.session.rollback()
+        raise
+    stats.log()
+
+
+def update(repo, session, identifiers):
+    """Update or remove the records of the given datasets, in one transaction"""
+    Record = repo.dataset
+    query = repo.session.query(Record.identifier).filter(Record.identifier.in_(identifiers))
+    stored = {identifier for (identifier,) in query}
+    hashes = get_hashes(repo)
+
+    # a few records are rendered faster than the worker processes start
+    stats = Stats(workers=1)
+    found = set()
+
+    def fetched_datasets():
+        for dataset in get_datasets_by_id(session, COAT_URL, identifiers):
+            found.add(dataset["id"])
+            yield dataset
+
+    repo.session.begin()
+    try:
+        refresh_users(repo, session)
+        fullnames = get_fullnames(repo)
+        index_datasets(repo, fetched_datasets(), fullnames, stored, hashes, stats)
+
+        # deleted or made private
+        deleted = stored - found
+        if deleted:
+            delete_records(repo, deleted)
+            log.info("Removed %d datasets", len(deleted))
+
+        repo.session.commit()
+    except Exception:
+        repo.session.rollback()
+        raise
+    stats.log()
+
+
+def due_datasets(client, debounce=DEBOUNCE):
+    """Take the datasets without changes for debounce seconds off the queue"""
+    identifiers = []
+    for member in client.zrangebyscore(CSW_QUEUE, "-inf", time.time() - debounce):
+        # another consumer may have taken it in the meantime
+        if client.zrem(CSW_QUEUE, member):
+            identifiers.append(member.decode())
+    return identifiers
+
+
+def listen(client, duration=INTERVAL, poll=1):
+    """Update the records of the datasets changed in CKAN, for duration seconds"""
+    repo = open_repository()
+    deadline = time.monotonic() + duration
+    with new_session() as session:
+        while time.monotonic() < deadline:
+            identifiers = due_datasets(client)
+            if not identifiers:
+                time.sleep(poll)
+                continue
+            try:
+                update(repo, session, identifiers)
+            except requests.RequestException:
+                log.exception("Could not retrieve %s, queued again", ", ".join(identifiers))
+                client.zadd(CSW_QUEUE, dict.fromkeys(identifiers, time.time()), nx=True)
+
+
+def open_repository():
+    context = pycsw.core.config.StaticContext()
+    try:
+        repository.setup(DATABASE, TABLE)
+    except OperationalError:
+        log.debug("Database already set up")
+
+    repo = repository.Repository(DATABASE, context, table=TABLE)
+    if repo.engine.dialect.name == "sqlite":
+        # the server keeps reading the last commit while a synchronisation writes
+        with repo.engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA journal_mode=WAL")
+    state_metadata.create_all(repo.engine)
+    return repo
+
+
+@retry(
+    stop=stop_after_delay(int(os.getenv("TIMEOUT", 300))),
+    retry=retry_if_exception_type((requests.ConnectionError, requests.Timeout)),
+    before_sleep=before_sleep_log(log, logging.WARNING),
+)
+def main(full=False):
+    log.info("Fetching datasets from %s", COAT_URL)
+    repo = open_repository()
+    with new_session() as session:
+        sync(repo, session, full)
     log.info("Done indexing")
 
 
 if __name__ == "__main__":
+    # a full synchronisation at startup picks up changes in the metadata mappings
+    main(full=True)
+    if REDIS_URL:
+        # only needed to consume the queue
+        import redis
+
+        client = redis.Redis.from_url(REDIS_URL)
     while True:
+        if REDIS_URL:
+            # the periodic runs only catch the changes missed by the queue
+            log.info("Listening for changes for %d seconds", INTERVAL)
+            listen(client)
+        else:
+            log.info("Sleeping for %d seconds", INTERVAL)
+            time.sleep(INTERVAL)
         main()
-        log.info("Sleeping for %d seconds", INTERVAL)
-        time.sleep(INTERVAL)
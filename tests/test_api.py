@@ -9,6 +9,7 @@ Requires:
 """
 
 import os
+import stat
 import uuid
 import zipfile
 from datetime import datetime, timedelta
@@ -687,6 +688,122 @@ class TestBulkDownload:
         zf = zipfile.ZipFile(BytesIO(resp.content))
         assert zf.namelist()
 
+    @pytest.fixture
+    def zip_pkg(self, client, org):
+        """Public dataset with one resource."""
+        pkg = client.create_package(org["id"], author=TEST_USER_EMAIL)
+        client.action(
+            "resource_create",
+            package_id=pkg["id"],
+            name="data.csv",
+            url=f"{BASE}/api/3/action/status_show",
+        )
+        return client.publish(pkg["id"])
+
+    @pytest.fixture
+    def other_pkg(self, client, org):
+        """Second public dataset, whose resource has the same URL as the one of zip_pkg."""
+        pkg = client.create_package(org["id"], author=TEST_USER_EMAIL)
+        client.action(
+            "resource_create",
+            package_id=pkg["id"],
+            name="other.csv",
+            url=f"{BASE}/api/3/action/status_show",
+        )
+        return client.publish(pkg["id"])
+
+    def test_zip_download_cached(self, zip_pkg):
+        """A second download of an unchanged public dataset is served from the cache."""
+        first = requests.get(f"{BASE}/dataset/{zip_pkg['name']}/zip", timeout=10)
+        second = requests.get(f"{BASE}/dataset/{zip_pkg['name']}/zip", timeout=10)
+        assert second.status_code == 200
+        assert second.headers["content-length"] == str(len(first.content))
+        assert second.content == first.content
+
+    def test_zip_download_conditional(self, zip_pkg):
+        """The archive has a stable ETag and unchanged archives are not sent again."""
+        url = f"{BASE}/dataset/{zip_pkg['name']}/zip"
+        first = requests.get(url, timeout=10)
+        etag = first.headers["etag"]
+        resp = requests.get(url, headers={"If-None-Match": etag}, timeout=10)
+        assert resp.status_code == 304
+        assert resp.headers["etag"] == etag
+
+    def test_zip_download_range(self, zip_pkg):
+        """Partial downloads can be resumed with a Range request."""
+        url = f"{BASE}/dataset/{zip_pkg['name']}/zip"
+        resp = requests.get(url, headers={"Range": "bytes=10-19"}, timeout=10)
+        assert resp.status_code == 206
+        full = requests.get(url, timeout=10)
+        assert full.headers["accept-ranges"] == "bytes"
+        assert resp.content == full.content[10:20]
+
+    def test_zip_download_store(self, zip_pkg):
+        """compression=store skips the compression of the archive members."""
+        url = f"{BASE}/dataset/{zip_pkg['name']}/zip"
+        resp = requests.get(url, params={"compression": "store"}, timeout=10)
+        assert resp.status_code == 200
+        for info in zipfile.ZipFile(BytesIO(resp.content)).infolist():
+            assert info.compress_size >= info.file_size
+
+    def test_datasets_zip_download(self, zip_pkg, other_pkg):
+        """Several datasets are downloaded as one archive with a folder per dataset."""
+        resp = requests.get(
+            f"{BASE}/datasets/zip", params={"id": [zip_pkg["name"], other_pkg["name"]]}, timeout=10
+        )
+        assert resp.status_code == 200
+        names = zipfile.ZipFile(BytesIO(resp.content)).namelist()
+        assert f"{zip_pkg['name']}/data.csv" in names
+        assert f"{other_pkg['name']}/other.csv" in names
+
+    def test_datasets_zip_download_skips_private(self, zip_pkg, pkg):
+        """Datasets the user cannot access are left out of the archive."""
+        url = f"{BASE}/datasets/zip"
+        resp = requests.get(url, params={"id": [zip_pkg["name"], pkg["name"]]}, timeout=10)
+        assert resp.status_code == 200
+        names = zipfile.ZipFile(BytesIO(resp.content)).namelist()
+        assert names == [f"{zip_pkg['name']}/data.csv"]
+        resp = requests.get(url, params={"id": pkg["name"]}, timeout=10)
+        assert resp.status_code == 404
+
+    def test_state_variable_zip_download(self, zip_pkg, other_pkg, client, org):
+        """A state variable is downloaded with its datasets, shared resources written in full."""
+        sv = client.create_sv(org["id"], zip_pkg["name"], other_pkg["name"])
+        sv = client.publish(sv["id"])
+        resp = requests.get(f"{BASE}/state-variable/{sv['name']}/zip", timeout=10)
+        assert resp.status_code == 200
+        zf = zipfile.ZipFile(BytesIO(resp.content))
+        first = zf.getinfo(f"{zip_pkg['name']}/data.csv")
+        second = zf.getinfo(f"{other_pkg['name']}/other.csv")
+        assert not stat.S_ISLNK(second.external_attr >> 16)
+        assert zf.read(second) == zf.read(first)
+
+    @pytest.mark.parametrize("output", ["geoparquet", "fgb", "tiles/0/0/0.mvt"])
+    def test_spatial_output_not_built(self, zip_pkg, output):
+        """Datasets without spatial data have no GeoParquet, FlatGeobuf or tile output."""
+        resp = requests.get(f"{BASE}/dataset/{zip_pkg['name']}/{output}", timeout=10)
+        assert resp.status_code == 404
+
+    def test_geojson_not_built(self, zip_pkg):
+        """Datasets without a GeoJSON file get an empty FeatureCollection."""
+        resp = requests.get(f"{BASE}/dataset/{zip_pkg['name']}/geojson", timeout=10)
+        assert resp.status_code == 200
+        assert resp.json() == {"type": "FeatureCollection", "features": [], "name": zip_pkg["name"]}
+
+    @pytest.mark.parametrize("params", [{"bbox": "1,2,3"}, {"bbox": "a,b,c,d"}, {"year": "20x0"}])
+    def test_geojson_malformed_filter(self, zip_pkg, params):
+        """Malformed bbox and year filters are rejected."""
+        resp = requests.get(f"{BASE}/dataset/{zip_pkg['name']}/geojson", params=params, timeout=10)
+        assert resp.status_code == 422
+
+    def test_geojson_filter_not_built(self, zip_pkg):
+        """Only the built GeoJSON files, which are indexed, can be filtered."""
+        resp = requests.get(
+            f"{BASE}/dataset/{zip_pkg['name']}/geojson", params={"sn_site": "x"}, timeout=10
+        )
+        assert resp.status_code == 404
+        assert resp.json()["detail"] == "This dataset cannot be filtered"
+
 
 class TestPycsw:
     """Smoke tests for the pycsw CSW endpoint."""
@@ -728,3 +845,32 @@ class TestPycsw:
         assert resp.status_code == 200, f"Expected 200, got {resp.status_code}"
         assert resp.headers["content-type"].startswith("application/xml")
         assert b"GetRecordsResponse" in resp.content
+
+    def has_record(self, identifier):
+        resp = requests.get(
+            self.PYCSW_URL,
+            params={
+                "service": "CSW",
+                "request": "GetRecordById",
+                "version": "2.0.2",
+                "id": identifier,
+                "elementsetname": "brief",
+            },
+            timeout=10,
+        )
+        assert resp.status_code == 200, f"Expected 200, got {resp.status_code}"
+        return identifier.encode() in resp.content
+
+    def test_record_follows_dataset_visibility(self, client, org):
+        """A published dataset gets a record, removed again when it is made private."""
+        pkg = client.create_package(org["id"], author=TEST_USER_EMAIL)
+        client.publish(pkg["id"])
+
+        # the records are updated a few seconds after the change
+        @retry(stop=stop_after_delay(60), wait=wait_fixed(2), reraise=True)
+        def wait_for_record(present):
+            assert self.has_record(pkg["id"]) is present
+
+        wait_for_record(True)
+        client.update_package(pkg["id"], private=True)
+        wait_for_record(False)